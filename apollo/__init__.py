@@ -1,7 +1,2 @@
 # check if it is a show or a movie
-# get format, duration, (language ?)
 # filter out useless metadata
-
-show_folder = "{name} ({year}) [{tmdbid}]"
-show_episode = "{name} S{season:02}E{episode:02}.{format}"
-
@@ -0,0 +1,85 @@
+import json
+import sqlite3
+import threading
+import time
+from pathlib import Path
+from typing import Any
+from urllib.parse import urlencode
+
+
+class Cache:
+    # evicting needs a full scan of the access index, so only do it every few writes
+    _evict_every = 256
+
+    def __init__(
+        self,
+        path: Path | str,
+        ttl: float = 7 * 24 * 3600,
+        negative_ttl: float = 24 * 3600,
+        max_entries: int = 100_000,
+    ) -> None:
+        if path != ":memory:":
+            Path(path).parent.mkdir(exist_ok=True, parents=True)
+        self._ttl = ttl
+        self._negative_ttl = negative_ttl
+        self._max_entries = max_entries
+        self._writes = 0
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS entries ("
+            "key TEXT PRIMARY KEY, value TEXT NOT NULL, expires REAL NOT NULL, accessed REAL NOT NULL)"
+        )
+        self._db.execute("CREATE INDEX IF NOT EXISTS entries_accessed ON entries (accessed)")
+        self.evict()
+
+    @staticmethod
+    def make_key(endpoint: str, params: dict[str, Any] | None = None) -> str:
+        if not params:
+            return endpoint
+        return endpoint + "?" + urlencode(sorted((key, str(value)) for key, value in params.items()))
+
+    def get(self, key: str) -> Any | None:
+        now = time.time()
+        with self._lock:
+            row = self._db.execute("SELECT value, expires FROM entries WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None
+            if row[1] < now:
+                self._db.execute("DELETE FROM entries WHERE key = ?", (key,))
+                return None
+            self._db.execute("UPDATE entries SET accessed = ? WHERE key = ?", (now, key))
+        return json.loads(row[0])
+
+    def set(self, key: str, value: Any, negative: bool = False) -> None:
+        now = time.time()
+        expires = now + (self._negative_ttl if negative else self._ttl)
+        with self._lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO entries (key, value, expires, accessed) VALUES (?, ?, ?, ?)",
+                (key, json.dumps(value), expires, now),
+            )
+            self._writes += 1
+            if self._writes % self._evict_every == 0:
+                self._evict()
+
+    def evict(self) -> None:
+        with self._lock:
+            self._evict()
+
+    def _evict(self) -> None:
+        self._db.execute("DELETE FROM entries WHERE expires < ?", (time.time(),))
+        self._db.execute(
+            "DELETE FROM entries WHERE key IN (SELECT key FROM entries ORDER BY accessed DESC LIMIT -1 OFFSET ?)",
+            (self._max_entries,),
+        )
+
+    def clear(self) -> None:
+        with self._lock:
+            self._db.execute("DELETE FROM entries")
+
+    def close(self) -> None:
+        with self._lock:
+            self._db.close()
@@ -1,24 +1,92 @@
 import argparse
-import datetime
+import concurrent.futures
+import cProfile
 import logging
+import os
+import re
+import sys
+import time
 import tomllib
-from typing import Any
+from typing import Any, Callable
 from pathlib import Path
 
-import guessit
+from apollo import (
+    cache,
+    fingerprint,
+    index,
+    library,
+    metrics,
+    naming,
+    nfo,
+    offline,
+    parse,
+    probe,
+    review,
+    scan,
+    tmdb,
+    transfer,
+    watch,
+)
 
-from apollo import tmdb
+COMMANDS = ("run", "plan", "watch", "apply", "undo", "titles", "reindex")
 
 
 def parse_args():
-    parser = argparse.ArgumentParser()
-    parser.add_argument("input", type=Path)
-    parser.add_argument("output", type=Path)
-    parser.add_argument("--settings", type=Path, default=Path("settings.toml"))
-    parser.add_argument("--preserve", action="store_true")
-    parser.add_argument("--dry-run", action="store_true")
-    parser.add_argument("-verbose", "-v", action="store_true")
-    args = parser.parse_args()
+    argv = sys.argv[1:]
+    # "apollo input output" stays the default command
+    if not argv or argv[0] not in (*COMMANDS, "-h", "--help"):
+        argv = ["run", *argv]
+
+    options = argparse.ArgumentParser(add_help=False)
+    options.add_argument("--settings", type=Path, default=Path("settings.toml"))
+    options.add_argument("-verbose", "-v", action="store_true")
+    options.add_argument("--profile", action="store_true", help="show where time went at the end")
+    options.add_argument("--cprofile", type=Path, help="also profile every function call, saved for pstats")
+
+    root_parser = argparse.ArgumentParser(prog="apollo")
+    commands = root_parser.add_subparsers(dest="command", required=True)
+
+    # what is needed to identify and name files, shared by run and plan
+    identify = argparse.ArgumentParser(add_help=False, parents=[options])
+    identify.add_argument("input", type=Path)
+    identify.add_argument("output", type=Path)
+    identify.add_argument("--preserve", action="store_true")
+    identify.add_argument("--batch", action="store_true", help="never prompt, queue uncertain matches for review")
+    identify.add_argument("--min-confidence", type=float, help="lowest match score processed in batch mode")
+    identify.add_argument("--review-queue", type=Path, help="where batch mode queues files to review")
+    identify.add_argument("--rescan", action="store_true", help="also process files already handled in a previous run")
+    identify.add_argument("--jobs", "-j", type=int, default=1, help="number of concurrent TMDB lookups")
+
+    parser = commands.add_parser("run", parents=[identify], help="identify, rename and move media files")
+    parser.add_argument("--dry-run", action="store_true", help="only show where files would go")
+    parser.add_argument("--review", action="store_true", help="only show files from the review queue (TUI)")
+
+    parser = commands.add_parser("plan", parents=[identify], help="write where files would go to a plan file")
+    parser.add_argument("plan", type=Path)
+    parser.set_defaults(dry_run=False, review=False)
+
+    parser = commands.add_parser("watch", parents=[identify], help="process new files as they appear in input")
+    parser.set_defaults(dry_run=False, review=False)
+
+    parser = commands.add_parser("apply", parents=[options], help="move files as written in a plan file")
+    parser.add_argument("plan", type=Path)
+
+    parser = commands.add_parser("undo", parents=[options], help="revert what applying a plan file did")
+    parser.add_argument("plan", type=Path)
+
+    parser = commands.add_parser("titles", parents=[options], help="build the offline title index")
+    parser.add_argument("exports", type=Path, nargs="+", help="TMDB daily ID export files (movie_ids_*.json.gz...)")
+    parser.add_argument("--type", choices=("movie", "tv"), help="media type listed in the exports")
+    parser.add_argument("--index", type=Path, help="where to write the index")
+
+    parser = commands.add_parser("reindex", parents=[options], help="remember the TMDB ids found in a library's NFOs")
+    parser.add_argument("library", type=Path)
+    parser.add_argument("--fingerprint", action="store_true", help="also remember the content of every media file")
+
+    args = root_parser.parse_args(argv)
+    if args.command == "watch":
+        # nobody is there to answer prompts, set here as parser defaults would leak through the shared parent
+        args.batch = True
 
     return args
 
@@ -42,19 +110,205 @@ def setup_logger(name: str):
     return logger
 
 
+def user_dir(env: str, fallback: str) -> Path:
+    return Path(os.environ.get(env) or Path.home() / fallback) / "apollo"
+
+
+def setup_cache(settings: dict[str, Any]) -> cache.Cache:
+    cache_settings = settings.get("cache", {})
+    if cache_settings.get("enabled", True):
+        path = Path(cache_settings.get("path", user_dir("XDG_CACHE_HOME", ".cache") / "tmdb.sqlite")).expanduser()
+    else:
+        # still deduplicate lookups within a run
+        path = ":memory:"
+    return cache.Cache(
+        path,
+        ttl=cache_settings.get("ttl", 7 * 24 * 3600),
+        negative_ttl=cache_settings.get("negative_ttl", 24 * 3600),
+        max_entries=cache_settings.get("max_entries", 100_000),
+    )
+
+
+def setup_naming(settings: dict[str, Any]) -> naming.Naming:
+    naming.default_naming.configure(settings.get("naming", {}))
+    return naming.default_naming
+
+
+def setup_watcher(
+    input: Path, settings: dict[str, Any], logger: logging.Logger, file_index: index.FileIndex | None
+) -> watch.Watcher:
+    watch_settings = settings.get("watch", {})
+    options = scan_options(settings)
+    return watch.Watcher(
+        input,
+        logger,
+        options["extensions"],
+        options["excludes"],
+        settle=watch_settings.get("settle", 5),
+        poll_interval=watch_settings.get("poll_interval", 10),
+        use_inotify=watch_settings.get("inotify", True),
+        file_index=file_index,
+    )
+
+
+def setup_profiler(args: argparse.Namespace) -> cProfile.Profile | None:
+    if args.cprofile is None:
+        return None
+    profiler = cProfile.Profile()
+    profiler.enable()
+    return profiler
+
+
+def report_metrics(
+    args: argparse.Namespace, settings: dict[str, Any], logger: logging.Logger, profiler: cProfile.Profile | None
+):
+    if profiler is not None:
+        # only the main thread is profiled, worker threads show up as time waiting for them
+        profiler.disable()
+        profiler.dump_stats(args.cprofile)
+        logger.info("Saved profile to %s, see python -m pstats %s", args.cprofile, args.cprofile)
+    if args.profile:
+        logger.info("Time spent per stage:\n%s", metrics.default_metrics.summary())
+    metrics_settings = settings.get("metrics", {})
+    if "json" in metrics_settings:
+        metrics.default_metrics.write(Path(metrics_settings["json"]).expanduser())
+    if "prometheus" in metrics_settings:
+        metrics.default_metrics.write(Path(metrics_settings["prometheus"]).expanduser(), prometheus=True)
+
+
+def setup_parser(settings: dict[str, Any]) -> parse.Parser:
+    parse.default_parser.start(settings.get("parse", {}).get("processes", 0))
+    return parse.default_parser
+
+
+def setup_index(settings: dict[str, Any]) -> index.FileIndex | None:
+    index_settings = settings.get("index", {})
+    if not index_settings.get("enabled", True):
+        return None
+    return index.FileIndex(
+        Path(index_settings.get("path", user_dir("XDG_STATE_HOME", ".local/state") / "files.sqlite")).expanduser(),
+        fingerprints=index_settings.get("fingerprint", True),
+    )
+
+
+def setup_review_queue(args: argparse.Namespace, settings: dict[str, Any]) -> review.ReviewQueue:
+    path = args.review_queue or settings.get("batch", {}).get(
+        "review_queue", user_dir("XDG_STATE_HOME", ".local/state") / "review.jsonl"
+    )
+    return review.ReviewQueue(Path(path).expanduser())
+
+
+def offline_index_path(settings: dict[str, Any]) -> Path:
+    path = settings.get("offline", {}).get("path", user_dir("XDG_DATA_HOME", ".local/share") / "titles.sqlite")
+    return Path(path).expanduser()
+
+
+def setup_offline_index(settings: dict[str, Any]) -> offline.OfflineIndex | None:
+    # optional, built beforehand with "apollo titles"
+    path = offline_index_path(settings)
+    if not settings.get("offline", {}).get("enabled", True) or not path.exists():
+        return None
+    return offline.OfflineIndex(path)
+
+
+def setup_library(output: Path, settings: dict[str, Any], logger: logging.Logger) -> library.LibraryIndex:
+    library_index = library.LibraryIndex()
+    start = time.perf_counter()
+    count = library_index.scan(output, scan_options(settings)["extensions"])
+    logger.info("Found %d media files in %s in %.2fs", count, output, time.perf_counter() - start)
+    return library_index
+
+
 def setup_tmdb_client(settings: dict[str, Any]):
-    tmdb_client = tmdb.TMDB(settings["tmdb"]["account_id"], settings["tmdb"]["token"])
+    tmdb_settings = settings["tmdb"]
+    tmdb_client = tmdb.TMDB(
+        tmdb_settings["account_id"],
+        tmdb_settings["token"],
+        cache=setup_cache(settings),
+        offline_index=setup_offline_index(settings),
+        url=tmdb_settings.get("url"),
+        pool_size=tmdb_settings.get("pool_size", 20),
+        timeout=tmdb_settings.get("timeout", 10),
+        rate_limit=tmdb_settings.get("rate_limit", 40),
+        max_retries=tmdb_settings.get("max_retries", 5),
+    )
     return tmdb_client
 
 
-def iterate_inputs(input: Path, logger: logging.Logger):
-    for file in input.rglob("*"):
-        if not file.is_file():
-            continue
-        if file.suffix not in [".mp4", ".mkv", ".avi"]:
-            logger.debug("Ignoring %s", file.absolute().as_posix())
+VIDEO_EXTENSIONS = frozenset({".mp4", ".mkv", ".avi"})
+
+
+def scan_options(settings: dict[str, Any]) -> dict[str, Any]:
+    scan_settings = settings.get("scan", {})
+    return {
+        "extensions": frozenset(ext.lower() for ext in scan_settings.get("extensions", VIDEO_EXTENSIONS)),
+        "excludes": tuple(scan_settings.get("exclude", ())),
+        "workers": scan_settings.get("workers", 0),
+    }
+
+
+@metrics.default_metrics.timed("scan.directory")
+def _scan_dir(
+    directory: str,
+    root: str,
+    extensions: frozenset[str],
+    excluded: re.Pattern | None,
+    file_index: index.FileIndex | None,
+    logger: logging.Logger,
+) -> tuple[list[Path], list[str]]:
+    entries, subdirs = scan.list_directory(directory, root, extensions, excluded, logger)
+    files = []
+    for entry in entries:
+        try:
+            if file_index is not None and file_index.is_done(entry.path, entry.stat()):
+                logger.debug("Skipping unchanged %s", entry.path)
+                continue
+        except FileNotFoundError:
+            # gone since it was listed
             continue
-        yield file
+        files.append(Path(entry.path))
+    metrics.default_metrics.count("scan.files", len(files))
+    return files, subdirs
+
+
+def iterate_inputs(
+    input: Path,
+    logger: logging.Logger,
+    extensions: frozenset[str] = VIDEO_EXTENSIONS,
+    excludes: tuple[str, ...] = (),
+    workers: int = 0,
+    file_index: index.FileIndex | None = None,
+):
+    root = os.fspath(input)
+    excluded = scan.exclude_pattern(excludes)
+
+    if workers <= 0:
+        directories = [root]
+        while directories:
+            files, subdirs = _scan_dir(directories.pop(), root, extensions, excluded, file_index, logger)
+            yield from files
+            directories.extend(reversed(subdirs))
+        return
+
+    # high latency filesystems: list several directories at once
+    with concurrent.futures.ThreadPoolExecutor(workers, thread_name_prefix="scan") as pool:
+        pending = {pool.submit(_scan_dir, root, root, extensions, excluded, file_index, logger)}
+        while pending:
+            done, pending = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                files, subdirs = future.result()
+                yield from files
+                pending.update(
+                    pool.submit(_scan_dir, subdir, root, extensions, excluded, file_index, logger) for subdir in subdirs
+                )
+
+
+def guess_media(file: Path, file_index: index.FileIndex | None = None) -> dict:
+    if file_index is not None:
+        entry = file_index.lookup(file)
+        if entry is not None and entry["guess"] is not None:
+            return entry["guess"]
+    return parse.default_parser.guess(file)
 
 
 def get_media_info(
@@ -63,22 +317,155 @@ def get_media_info(
     logger: logging.Logger,
     forced_type: str | None = None,
     forced_title: str | None = None,
+    guess: dict | None = None,
+    file_index: index.FileIndex | None = None,
 ):
 
-    guess = guessit.guessit(file)
-    logger.debug("Guess data: %", guess)
+    if not (forced_type or forced_title):
+        known = None
+        if file_index is not None:
+            entry = file_index.lookup(file)
+            # matches found by a search are searched again, they may have been wrong or skipped
+            if entry is not None and entry["tmdb_id"] is not None and entry["confirmed"]:
+                logger.debug("Using indexed match for %s", file)
+                known = entry["media_type"], entry["tmdb_id"], entry["season"], entry["episode"]
+        if known is not None:
+            media_type, result, extra_infos = known_media_info(tmdb_client, *known)
+            return media_type, dict(result, confirmed=True), extra_infos
+        if file.with_suffix(".nfo").is_file():
+            try:
+                known = nfo.identify(file.with_suffix(".nfo"))
+            except nfo.InvalidNfo as exc:
+                logger.debug("%s", exc)
+            if known is not None:
+                logger.debug("Using NFO match for %s", file)
+                media_type, result, extra_infos = known_media_info(tmdb_client, *known)
+                return media_type, dict(result, confirmed=True), extra_infos
+        content = file_fingerprint(file, file_index) if file_index is not None and file_index.fingerprints else None
+        if content is not None:
+            media_info = file_index.match(content)
+            if media_info is not None:
+                # a renamed copy of a file that was already processed
+                logger.debug("Using the match confirmed for the same content as %s", file)
+                media_type, result, extra_infos = media_info
+                file_index.record(
+                    file,
+                    media_type=media_type,
+                    tmdb_id=result["id"],
+                    season=extra_infos.get("season_number"),
+                    episode=extra_infos.get("episode_number"),
+                    confirmed=True,
+                )
+                return media_type, dict(result, confirmed=True), extra_infos
+
+    guess = guess or guess_media(file, file_index)
+    logger.debug("Guess data: %s", guess)
+    media_type = forced_type or guess["type"]
+
+    result = tmdb_client.search(
+        search_title(guess, forced_title),
+        video_type={"movie": "movie", "episode": "tv"}[media_type],
+        year=guess.get("year"),
+        language=guess_language(guess),
+    )
+    return select_candidate(tmdb_client, file, guess, media_type, result, file_index)
+
+
+def file_fingerprint(file: Path, file_index: index.FileIndex) -> str | None:
+    stat = os.stat(file)
+    if stat.st_size < fingerprint.MIN_SIZE:
+        return None
+    entry = file_index.lookup(file, stat)
+    if entry is not None and entry["fingerprint"] is not None:
+        return entry["fingerprint"]
+    with metrics.default_metrics.timer("fingerprint"):
+        value = fingerprint.opensubtitles_hash(file)
+    file_index.record(file, stat, fingerprint=value)
+    return value
+
+
+def probe_file(file: Path, file_index: index.FileIndex | None, logger: logging.Logger) -> dict[str, Any] | None:
+    # probed once per content, renamed or moved copies reuse it
+    content = file_fingerprint(file, file_index) if file_index is not None and file_index.fingerprints else None
+    if content is not None:
+        streams = file_index.probe(content)
+        if streams is not None:
+            return streams
+    try:
+        with metrics.default_metrics.timer("probe"):
+            streams = probe.probe(file)
+    except (probe.ProbeError, OSError) as exc:
+        logger.warning("Unable to probe %s: %s", file, exc)
+        return None
+    if content is not None and streams is not None:
+        file_index.record_probe(content, streams)
+    return streams
+
+
+def duplicates(file: Path, file_index: index.FileIndex | None) -> list[Path]:
+    # other files known to have the same content, input or output
+    if file_index is None or not file_index.fingerprints:
+        return []
+    content = file_fingerprint(file, file_index)
+    if content is None:
+        return []
+    key = os.path.abspath(file)
+    return [Path(path) for path in file_index.with_fingerprint(content) if path != key and os.path.exists(path)]
+
+
+def known_media_info(tmdb_client: tmdb.TMDB, media_type: str, tmdb_id: int, season: int | None, episode: int | None):
+    # ids read from an NFO or the index may no longer exist on TMDB
+    if media_type == "movie":
+        movie = tmdb_client.get_movie(tmdb_id)
+        if "id" not in movie:
+            raise tmdb.MovieNotFound(f"Unable to find movie {tmdb_id}")
+        return "movie", movie, {}
+    # the season is appended to the show, a single request for both
+    show = tmdb_client.get_show(tmdb_id, (season,))
+    if "id" not in show:
+        raise tmdb.MovieNotFound(f"Unable to find show {tmdb_id}")
+    extra_infos = tmdb_client.search_episode(tmdb_id, season, episode, show.get(f"season/{season}"))
+    return "episode", {key: value for key, value in show.items() if key != f"season/{season}"}, extra_infos
+
+
+def search_title(guess: dict, forced_title: str | None = None) -> str:
     processed_guess_title = guess["title"]
     if guess.get("part"):
         processed_guess_title += " " + str(guess["part"])
-    guess_title = forced_title or guess.get("alternative_title") or processed_guess_title
-    media_type = forced_type or guess["type"]
+    return forced_title or guess.get("alternative_title") or processed_guess_title
 
-    result = tmdb_client.search(
-        guess_title,
+
+def guess_language(guess: dict) -> str | None:
+    language = guess.get("language")
+    if isinstance(language, list):
+        language = language[0] if language else None
+    # babelfish languages print as "fr" or "fr-CA", TMDB uses the ISO 639-1 part
+    return str(language).split("-")[0] if language else None
+
+
+def search_candidates(
+    tmdb_client: tmdb.TMDB,
+    guess: dict,
+    media_type: str,
+    forced_title: str | None = None,
+) -> list[dict]:
+    return tmdb_client.search_candidates(
+        search_title(guess, forced_title),
         video_type={"movie": "movie", "episode": "tv"}[media_type],
         year=guess.get("year"),
+        language=guess_language(guess),
     )
 
+
+def select_candidate(
+    tmdb_client: tmdb.TMDB,
+    file: Path,
+    guess: dict,
+    media_type: str,
+    result: dict,
+    file_index: index.FileIndex | None = None,
+    confirmed: bool = False,
+):
     if media_type == "movie":
         extra_infos = {}
     elif media_type == "episode":
@@ -87,11 +474,42 @@ def get_media_info(
         episode_number = guess["episode"]
         extra_infos = tmdb_client.search_episode(tmdb_id, season_number, episode_number)
 
+    if file_index is not None:
+        file_index.record(
+            file,
+            guess=guess,
+            media_type=media_type,
+            tmdb_id=result["id"],
+            season=extra_infos.get("season_number"),
+            episode=extra_infos.get("episode_number"),
+            confirmed=confirmed,
+        )
+
     return media_type, result, extra_infos
 
 
-def extract_year(date: str) -> str:
-    return str(datetime.datetime.strptime(date, "%Y-%m-%d").year)
+def setup_transfer_queue(
+    settings: dict[str, Any],
+    on_progress: Callable[[transfer.TransferProgress], None] | None = None,
+) -> transfer.TransferQueue:
+    transfer_settings = settings.get("transfer", {})
+    return transfer.TransferQueue(
+        workers=transfer_settings.get("workers", 4),
+        per_device=transfer_settings.get("per_device", 1),
+        fsync=transfer_settings.get("fsync", False),
+        on_progress=on_progress,
+    )
+
+
+def log_transfer(logger: logging.Logger, destination: Path, result: transfer.TransferResult, move: bool):
+    logger.info(
+        "%s %s in %.2fs (%.1f MiB/s, %s)",
+        "Moved" if move else "Copied",
+        destination,
+        result.seconds,
+        result.rate / 2**20,
+        result.method,
+    )
 
 
 def generate_new_path(
@@ -100,20 +518,6 @@ def generate_new_path(
     media_type: str,
     media_infos: dict,
     extra_infos: dict,
+    streams: dict | None = None,
 ) -> Path:
-
-    if media_type == "movie":
-        file_name = f"{media_infos['title']} ({extract_year(media_infos['release_date'])}) [tmdbid-{media_infos['id']}]"
-        output_file = output / "movie" / file_name / (file_name + file.suffix)
-
-    elif media_type == "episode":
-        folder_name = (
-            f"{media_infos['name']} ({extract_year(media_infos['first_air_date'])}) [tmdbid-{media_infos['id']}]"
-        )
-        file_name = f"{media_infos['name']} S{extra_infos['season_number']:02}E{extra_infos['episode_number']:02} {extra_infos['name']}"
-
-        output_file = (
-            output / "show" / folder_name / f"Season{extra_infos['season_number']:02}" / (file_name + file.suffix)
-        )
-
-    return output_file
+    return output.joinpath(*naming.default_naming.path(media_type, media_infos, extra_infos, file.suffix, streams))
@@ -0,0 +1,22 @@
+import os
+import struct
+from pathlib import Path
+
+BLOCK_SIZE = 64 * 1024
+# below this the two blocks overlap, small files are too alike to be told apart
+MIN_SIZE = 2 * BLOCK_SIZE
+
+
+def opensubtitles_hash(path: Path | str) -> str:
+    # file size plus the first and last 64 KiB summed as little endian 64-bit words, never reads the rest
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        size = os.fstat(fd).st_size
+        value = size
+        for offset in (0, max(0, size - BLOCK_SIZE)):
+            block = os.pread(fd, BLOCK_SIZE, offset)
+            block += b"\0" * (-len(block) % 8)
+            value += sum(struct.unpack(f"<{len(block) // 8}Q", block))
+    finally:
+        os.close(fd)
+    return f"{value & 0xFFFFFFFFFFFFFFFF:016x}"
@@ -0,0 +1,139 @@
+import contextlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from pathlib import Path
+from typing import Any
+
+_columns = ("guess", "media_type", "tmdb_id", "season", "episode", "outcome", "fingerprint", "confirmed")
+
+
+class FileIndex:
+    # remembers what was found for each input file, valid as long as the file is unchanged
+    def __init__(self, path: Path | str, fingerprints: bool = True) -> None:
+        self.fingerprints = fingerprints
+        if path != ":memory:":
+            Path(path).parent.mkdir(exist_ok=True, parents=True)
+        # reentrant so records can happen inside batch()
+        self._lock = threading.RLock()
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS files ("
+            "path TEXT PRIMARY KEY, size INTEGER NOT NULL, mtime_ns INTEGER NOT NULL, inode INTEGER NOT NULL, "
+            "guess TEXT, media_type TEXT, tmdb_id INTEGER, season INTEGER, episode INTEGER, outcome TEXT, "
+            "updated REAL NOT NULL)"
+        )
+        columns = {row[1] for row in self._db.execute("PRAGMA table_info(files)")}
+        if "fingerprint" not in columns:
+            # index written before fingerprints were stored
+            self._db.execute("ALTER TABLE files ADD COLUMN fingerprint TEXT")
+        if "confirmed" not in columns:
+            # matches found by a search, as opposed to read from an NFO, the same content or chosen by the user
+            self._db.execute("ALTER TABLE files ADD COLUMN confirmed INTEGER NOT NULL DEFAULT 0")
+        self._db.execute("CREATE INDEX IF NOT EXISTS files_fingerprint ON files (fingerprint)")
+        # what was confirmed for a given content, whatever the file is named now
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS matches ("
+            "fingerprint TEXT PRIMARY KEY, media_info TEXT NOT NULL, updated REAL NOT NULL)"
+        )
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS probes ("
+            "fingerprint TEXT PRIMARY KEY, streams TEXT NOT NULL, updated REAL NOT NULL)"
+        )
+
+    @staticmethod
+    def _key(file: Path | str) -> str:
+        return os.path.abspath(file)
+
+    def lookup(self, file: Path | str, stat: os.stat_result | None = None) -> dict[str, Any] | None:
+        stat = stat or os.stat(file)
+        with self._lock:
+            row = self._db.execute(
+                f"SELECT size, mtime_ns, inode, {', '.join(_columns)} FROM files WHERE path = ?", (self._key(file),)
+            ).fetchone()
+        if row is None or tuple(row[:3]) != (stat.st_size, stat.st_mtime_ns, stat.st_ino):
+            return None
+        entry = dict(zip(_columns, row[3:]))
+        if entry["guess"] is not None:
+            entry["guess"] = json.loads(entry["guess"])
+        return entry
+
+    def is_done(self, file: Path | str, stat: os.stat_result | None = None) -> bool:
+        entry = self.lookup(file, stat)
+        # files queued for review are offered again on the next run
+        return entry is not None and entry["outcome"] not in (None, "review")
+
+    def record(self, file: Path | str, stat: os.stat_result | None = None, **values: Any) -> None:
+        unknown = set(values) - set(_columns)
+        if unknown:
+            raise TypeError(f"Unknown index columns: {', '.join(sorted(unknown))}")
+        stat = stat or os.stat(file)
+        if "guess" in values and values["guess"] is not None:
+            values["guess"] = json.dumps(dict(values["guess"]), default=str)
+
+        key = self._key(file)
+        with self._lock:
+            current = self._db.execute("SELECT size, mtime_ns, inode FROM files WHERE path = ?", (key,)).fetchone()
+            if current is None or tuple(current) != (stat.st_size, stat.st_mtime_ns, stat.st_ino):
+                # new or changed file, forget what was known about the previous one
+                self._db.execute(
+                    "INSERT OR REPLACE INTO files (path, size, mtime_ns, inode, updated) VALUES (?, ?, ?, ?, ?)",
+                    (key, stat.st_size, stat.st_mtime_ns, stat.st_ino, time.time()),
+                )
+            if values:
+                assignments = ", ".join(f"{column} = ?" for column in values)
+                self._db.execute(
+                    f"UPDATE files SET {assignments}, updated = ? WHERE path = ?",
+                    (*values.values(), time.time(), key),
+                )
+
+    def with_fingerprint(self, fingerprint: str) -> list[str]:
+        with self._lock:
+            rows = self._db.execute("SELECT path FROM files WHERE fingerprint = ?", (fingerprint,)).fetchall()
+        return [path for path, in rows]
+
+    def record_match(self, fingerprint: str, media_info: tuple[str, dict, dict]) -> None:
+        with self._lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO matches VALUES (?, ?, ?)", (fingerprint, json.dumps(media_info), time.time())
+            )
+
+    def match(self, fingerprint: str) -> tuple[str, dict, dict] | None:
+        with self._lock:
+            row = self._db.execute("SELECT media_info FROM matches WHERE fingerprint = ?", (fingerprint,)).fetchone()
+        return tuple(json.loads(row[0])) if row is not None else None
+
+    def record_probe(self, fingerprint: str, streams: dict[str, Any]) -> None:
+        with self._lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO probes VALUES (?, ?, ?)", (fingerprint, json.dumps(streams), time.time())
+            )
+
+    def probe(self, fingerprint: str) -> dict[str, Any] | None:
+        with self._lock:
+            row = self._db.execute("SELECT streams FROM probes WHERE fingerprint = ?", (fingerprint,)).fetchone()
+        return json.loads(row[0]) if row is not None else None
+
+    @contextlib.contextmanager
+    def batch(self):
+        # a single transaction for many records, other threads wait until it is over
+        with self._lock:
+            self._db.execute("BEGIN")
+            try:
+                yield self
+            except BaseException:
+                self._db.execute("ROLLBACK")
+                raise
+            self._db.execute("COMMIT")
+
+    def forget(self, file: Path | str) -> None:
+        with self._lock:
+            self._db.execute("DELETE FROM files WHERE path = ?", (self._key(file),))
+
+    def close(self) -> None:
+        with self._lock:
+            self._db.close()
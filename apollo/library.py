@@ -0,0 +1,67 @@
+import os
+import threading
+from pathlib import Path
+
+from apollo import scan
+from apollo.naming import default_naming
+
+
+def media_key(path: Path | str) -> tuple | None:
+    # read back from the names the configured templates give
+    return default_naming.media_key(path)
+
+
+class LibraryIndex:
+    # media already in the output library, so collisions are found without touching its filesystem
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._paths: set[str] = set()
+        self._media: dict[tuple, set[str]] = {}
+
+    def scan(self, root: Path, extensions: frozenset[str]) -> int:
+        count = 0
+        directories = [os.fspath(root)]
+        while directories:
+            try:
+                with os.scandir(directories.pop()) as entries:
+                    for entry in entries:
+                        if entry.is_dir(follow_symlinks=False):
+                            directories.append(entry.path)
+                        elif scan.is_media(entry.name, extensions):
+                            self.add(entry.path)
+                            count += 1
+            except OSError:
+                # missing output folder or unreadable directory, nothing to index there
+                continue
+        return count
+
+    def add(self, path: Path | str) -> None:
+        path = os.path.abspath(path)
+        key = media_key(path)
+        with self._lock:
+            self._paths.add(path)
+            if key is not None:
+                self._media.setdefault(key, set()).add(path)
+
+    def remove(self, path: Path | str) -> None:
+        path = os.path.abspath(path)
+        key = media_key(path)
+        with self._lock:
+            self._paths.discard(path)
+            if key in self._media:
+                self._media[key].discard(path)
+                if not self._media[key]:
+                    del self._media[key]
+
+    def exists(self, path: Path | str) -> bool:
+        with self._lock:
+            return os.path.abspath(path) in self._paths
+
+    def find(self, media_type: str, tmdb_id: int, season: int | None = None, episode: int | None = None) -> list[Path]:
+        key = ("movie", tmdb_id) if media_type == "movie" else ("episode", tmdb_id, season, episode)
+        with self._lock:
+            return sorted(Path(path) for path in self._media.get(key, ()))
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._paths)
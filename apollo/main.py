@@ -1,11 +1,28 @@
-import datetime
+import argparse
+import functools
 import logging
+import os
+from concurrent.futures import Future, ThreadPoolExecutor
 from pathlib import Path
-import shutil
+from typing import Iterable, Iterator
 
-from apollo import common, nfo, tmdb
+import requests
 
-import guessit
+from apollo import (
+    common,
+    fingerprint,
+    index,
+    library,
+    metrics,
+    naming,
+    nfo,
+    offline,
+    pipeline,
+    plan,
+    review,
+    scoring,
+    tmdb,
+)
 
 logging.basicConfig(level=logging.INFO)
 
@@ -16,110 +33,514 @@ class MaybeInvalidMediaType(Exception):
     pass
 
 
+@metrics.default_metrics.timed("identify")
+def resolve_file(
+    tmdb_client: tmdb.TMDB,
+    file: Path,
+    guess: dict | None = None,
+    forced_type: str | None = None,
+    forced_title: str | None = None,
+    file_index: index.FileIndex | None = None,
+):
+    try:
+        return common.get_media_info(
+            tmdb_client, file, logger, forced_type, forced_title, guess=guess, file_index=file_index
+        )
+    except KeyError as exc:
+        # guessit did not find a title, or a season/episode for a show
+        raise MaybeInvalidMediaType(file) from exc
 
 
-def rename_file(output: Path, suffix: str, media_type: str, media_info: dict):
-    overview = media_info["overview"]
-    tmdb_id = str(media_info["id"])
-    if media_type == "movie":
-        title = media_info["title"]
-        original_title = media_info["original_title"]
+def iterate_media_infos(
+    tmdb_client: tmdb.TMDB,
+    files: Iterable[Path],
+    jobs: int = 1,
+    file_index: index.FileIndex | None = None,
+    guess_jobs: int = 1,
+) -> Iterator[tuple[Path, Future]]:
+    if jobs <= 1:
+        for file in files:
+            yield file, pipeline.call(resolve_file, tmdb_client, file, file_index=file_index)
+        return
 
-        year = str(
-            datetime.datetime.strptime(media_info["release_date"], "%Y-%m-%d").year
+    # scan -> guessit -> TMDB lookups, each stage a bounded window ahead of the one after it
+    window = 2 * jobs
+    with (
+        ThreadPoolExecutor(guess_jobs, thread_name_prefix="guess") as guess_pool,
+        ThreadPoolExecutor(jobs, thread_name_prefix="lookup") as lookup_pool,
+    ):
+        files = pipeline.prefetch(files, window)
+        guesses = pipeline.ordered_map(guess_pool, lambda file: common.guess_media(file, file_index), files, window)
+        media_infos = pipeline.ordered_map(
+            lookup_pool,
+            lambda guessed: resolve_file(tmdb_client, guessed[0], guess=guessed[1].result(), file_index=file_index),
+            guesses,
+            window,
         )
-        file_name = f"{title} ({year}) [tmdbid-{tmdb_id}]"
-
-        output_folder = output / "movie" / file_name
-        output_file = output_folder / f"{file_name}{suffix}"
-        output_nfo = output_folder / f"{file_name}.nfo"
+        for (file, _), media_info in media_infos:
+            yield file, media_info
 
-    elif media_type == "episode":
-        series_name = media_info["name"]
-        year = str(
-            datetime.datetime.strptime(media_info["first_air_date"], "%Y-%m-%d").year
-        )
-        try:
-            season_number = guess["season"]
-        except KeyError:
-            raise MaybeInvalidMediaType
-        episode_number = guess["episode"]
-
-        episode_result = tmdb_client.search_episode(
-            tmdb_id, season_number, episode_number
-        )
-        episode_name = episode_result["name"]
-        tmdb_episode_id = episode_result["id"]
 
-        output_series_folder = output / f"{series_name} ({year}) [tmdbid-{tmdb_id}]"
-        output_season_folder = output_series_folder / f"Season{season_number:02}"
-        file_name = f"{series_name} S{season_number:02}E{episode_number:02} {episode_name} [tmdbid-{tmdb_episode_id}]"
-        output_file = output_season_folder / f"{file_name}{suffix}"
+def _transfer_done(
+    file_index: index.FileIndex | None,
+    library_index: library.LibraryIndex | None,
+    entry: dict,
+    stat: os.stat_result,
+    future: Future,
+):
+    file, output_file = Path(entry["source"]), Path(entry["destination"])
+    outcome = "moved" if entry["move"] else "copied"
+    try:
+        common.log_transfer(logger, output_file, future.result(), move=entry["move"])
+    except OSError as exc:
+        logger.error("Unable to transfer %s to %s: %s", file, output_file, exc)
+        outcome = "failed"
+    if library_index is not None:
+        # the destination was added when the transfer was planned
+        if outcome == "failed":
+            library_index.remove(output_file)
+        elif outcome == "moved":
+            library_index.remove(file)
+    if file_index is not None:
+        file_index.record(file, stat, outcome=outcome)
+        if entry["fingerprint"] is not None and outcome != "failed":
+            # same content, no need to read the destination again
+            file_index.record(output_file, fingerprint=entry["fingerprint"])
+            if entry["match"] is not None:
+                file_index.record_match(entry["fingerprint"], tuple(entry["match"]))
 
-    else:
-        raise NotImplementedError(guess["type"])
 
-    return output_file, output_nfo
+def choose_candidate(
+    tmdb_client: tmdb.TMDB,
+    file: Path,
+    media_info: tuple[str, dict, dict],
+    file_index: index.FileIndex | None = None,
+    count: int = 5,
+) -> tuple[str, dict, dict]:
+    media_type, result, _ = media_info
+    guess = common.guess_media(file, file_index)
+    candidates = common.search_candidates(tmdb_client, guess, media_type)[:count]
+    for position, candidate in enumerate(candidates, 1):
+        date = candidate.get("release_date") or candidate.get("first_air_date") or "?"
+        logger.info(
+            "%d. %s (%s) [tmdbid-%s] score %.2f%s",
+            position,
+            candidate.get("title") or candidate.get("name"),
+            date[:4],
+            candidate["id"],
+            candidate["score"],
+            " *" if candidate["id"] == result["id"] else "",
+        )
+    answer = input("Candidate number (empty to keep current): ")
+    if not answer.isdigit() or not 1 <= int(answer) <= len(candidates):
+        return media_info
+    return common.select_candidate(
+        tmdb_client, file, guess, media_type, candidates[int(answer) - 1], file_index, confirmed=True
+    )
 
 
-def process_file(
+def plan_file(
     tmdb_client: tmdb.TMDB,
     output: Path,
     file: Path,
+    media_info: tuple[str, dict, dict],
     preserve: bool = False,
     dry_run: bool = False,
-    forced_type: str | None = None,
-    forced_title: str | None = None,
-):
+    file_index: index.FileIndex | None = None,
+    interactive: bool = True,
+    library_index: library.LibraryIndex | None = None,
+) -> dict | None:
+    # everything decided about a file, see plan.py, without touching the output folder
     logger.info("Processing %s", file)
-    media_type, result = get_media_info(tmdb_client, file, forced_type, forced_title)
+    media_type, result, extra_infos = media_info
+
+    # only probed up front when the naming template needs it
+    streams = None
+    while True:
+        if streams is None and naming.default_naming.needs_streams(media_type):
+            streams = common.probe_file(file, file_index, logger)
+        output_file = common.generate_new_path(output, file, media_type, result, extra_infos, streams)
+
+        # check if file already exists, from the library index when there is one
+        if library_index is not None:
+            if library_index.exists(output_file):
+                logger.warning("File %s already exists", output_file)
+            for existing in library_index.find(
+                media_type, result["id"], extra_infos.get("season_number"), extra_infos.get("episode_number")
+            ):
+                if existing != Path(os.path.abspath(output_file)):
+                    logger.warning("%s is already in the library as %s", file, existing)
+        elif output_file.exists():
+            logger.warning("File %s already exists", output_file)
+        for duplicate in common.duplicates(file, file_index):
+            logger.warning("%s has the same content as %s", file, duplicate)
+
+        # moving file
+        logger.info("%s -> %s", file, output_file)
+        answer = input("Press key to proceed, s to skip or c to choose another match") if interactive else ""
+        if answer != "c":
+            break
+        media_type, result, extra_infos = choose_candidate(
+            tmdb_client, file, (media_type, result, extra_infos), file_index
+        )
+
+    stat = file.stat()
+    if answer == "s":
+        if file_index is not None and not dry_run:
+            file_index.record(file, stat, outcome="skipped")
+        return None
+    if library_index is not None:
+        # files later in the run are checked against this one too, even in a dry run
+        library_index.add(output_file)
+    if dry_run:
+        return None
+
+    content = None
+    if file_index is not None and file_index.fingerprints:
+        content = common.file_fingerprint(file, file_index)
+
+    return {
+        # absolute, the plan may be applied from another folder
+        "source": os.path.abspath(file),
+        "destination": os.path.abspath(output_file),
+        "move": not preserve,
+        "media_type": media_type,
+        "tmdb_id": result["id"],
+        "season": extra_infos.get("season_number"),
+        "episode": extra_infos.get("episode_number"),
+        "fingerprint": content,
+        # remembered for this content once the file is transferred, not when only planned
+        "match": (media_type, result, extra_infos) if content is not None else None,
+        "size": stat.st_size,
+        "mtime_ns": stat.st_mtime_ns,
+        "nfos": nfo_payloads(
+            Path(os.path.abspath(output_file.with_suffix(".nfo"))),
+            media_type,
+            result,
+            extra_infos,
+            streams or common.probe_file(file, file_index, logger),
+        ),
+    }
+
+
+def nfo_payloads(
+    output_nfo: Path, media_type: str, result: dict, extra_infos: dict, streams: dict | None = None
+) -> list[tuple[str, str, list, bool]]:
+    # (path, root, fields, overwrite) of the NFOs to write next to the file
+    file_fields = [nfo.fileinfo(streams)] if streams is not None else []
+    if media_type == "movie":
+        fields = [
+            ("title", result["title"]),
+            ("originaltitle", result.get("original_title")),
+            ("plot", result.get("overview")),
+            ("year", naming.year(result.get("release_date"))),
+            ("tmdbid", result["id"]),
+            ("lockdata", "true"),
+            *file_fields,
+        ]
+        return [(str(output_nfo), "movie", fields, True)]
+
+    # the show NFO goes in the show folder of the episode template, and is only written once
+    show_fields = [
+        ("title", result["name"]),
+        ("originaltitle", result.get("original_name")),
+        ("plot", result.get("overview")),
+        ("year", naming.year(result.get("first_air_date"))),
+        ("premiered", result["first_air_date"]),
+        ("tmdbid", result["id"]),
+        ("lockdata", "true"),
+    ]
+    fields = [
+        ("title", extra_infos["name"]),
+        ("showtitle", result["name"]),
+        ("season", extra_infos["season_number"]),
+        ("episode", extra_infos["episode_number"]),
+        ("plot", extra_infos.get("overview")),
+        ("aired", extra_infos.get("air_date")),
+        ("tmdbid", extra_infos.get("id")),
+        ("lockdata", "true"),
+        *file_fields,
+    ]
+    payloads = [(str(output_nfo), "episodedetails", fields, True)]
+    show_folder = naming.default_naming.show_folder(output_nfo)
+    if show_folder is not None:
+        payloads.insert(0, (str(show_folder / "tvshow.nfo"), "tvshow", show_fields, False))
+    return payloads
+
+
+def queue_for_review(
+    review_queue: review.ReviewQueue | None,
+    file: Path,
+    file_index: index.FileIndex | None,
+    reason: str,
+    **details,
+):
+    if review_queue is None:
+        # dry run, nothing is remembered
+        logger.warning("%s would be queued for review: %s", file, reason)
+        return
+    logger.warning("Queuing %s for review: %s", file, reason)
+    review_queue.append(file, reason, **details)
+    if file_index is not None:
+        file_index.record(file, outcome="review")
 
-    # TODO: open old nfo file and try to match tmdbid
 
-    output_file, output_nfo = rename_file(output, file.suffix, media_type, result)
+def build_titles(args: argparse.Namespace, settings: dict):
+    offline_index = offline.OfflineIndex(args.index or common.offline_index_path(settings))
+    try:
+        for export_file in args.exports:
+            media_type = args.type or offline.export_media_type(export_file)
+            count = offline_index.build(offline.read_export(export_file), media_type)
+            logger.info("Indexed %d %s titles from %s", count, media_type, export_file)
+    finally:
+        offline_index.close()
 
-    # check if file already exists
-    if output_file.exists():
-        logger.warning("File %s already exists", output_file)
 
-    # moving file
-    logger.info("%s -> %s", file, output_file)
-    if input("Press key to proceed or s to skip") == "s":
+def reindex(args: argparse.Namespace, settings: dict):
+    file_index = common.setup_index(settings)
+    if file_index is None:
+        logger.error("The file index is disabled, nothing to reindex into")
         return
-    if not dry_run:
-        output_file.parent.mkdir(exist_ok=True, parents=True)
-        if preserve:
-            shutil.copy(file, output_file)
+    # only needed to remember what each content is, so renamed copies are found without searching
+    tmdb_client = common.setup_tmdb_client(settings) if args.fingerprint else None
+    options = common.scan_options(settings)
+    options["extensions"] = options["extensions"] | {".nfo"}
+    nfo_files = set()
+    media_files = []
+    for file in common.iterate_inputs(args.library, logger, **options):
+        if file.suffix.lower() == ".nfo":
+            nfo_files.add(file)
         else:
-            file.rename(output_file)
-        # creating nfo data
-        nfo.create_nfo(title, original_title, overview, tmdb_id, year, output_nfo)
+            media_files.append(file)
 
+    def _identify(file: Path):
+        values = {}
+        media_info = None
+        if args.fingerprint:
+            try:
+                values["fingerprint"] = fingerprint.opensubtitles_hash(file)
+            except OSError as exc:
+                logger.warning("Unable to read %s: %s", file, exc)
+        if file.with_suffix(".nfo") in nfo_files:
+            try:
+                known = nfo.identify(file.with_suffix(".nfo"))
+            except nfo.InvalidNfo as exc:
+                logger.warning("%s", exc)
+                known = None
+            if known is not None:
+                values.update(zip(("media_type", "tmdb_id", "season", "episode"), known), confirmed=True)
+                if "fingerprint" in values:
+                    try:
+                        media_info = common.known_media_info(tmdb_client, *known)
+                    except (tmdb.MovieNotFound, requests.RequestException) as exc:
+                        logger.warning("Unable to look %s up: %s", file, exc)
+        return values, media_info
 
-def run():
-    args = common.parse_args()
-    settings = common.load_settings(args, logger)
-    common.set_log_level(args, logger)
+    if not args.fingerprint:
+        media_files = [file for file in media_files if file.with_suffix(".nfo") in nfo_files]
+    count = 0
+    with ThreadPoolExecutor(max(1, options["workers"]), thread_name_prefix="reindex") as pool, file_index.batch():
+        for file, (values, media_info) in zip(media_files, pool.map(_identify, media_files)):
+            if not values:
+                continue
+            file_index.record(file, **values)
+            count += "tmdb_id" in values
+            if media_info is not None:
+                media_type, result, extra_infos = media_info
+                file_index.record_match(values["fingerprint"], (media_type, dict(result, confirmed=True), extra_infos))
+    logger.info("Indexed %d of %d media files in %s from their NFO", count, len(media_files), args.library)
+    file_index.close()
+
+
+def apply_plan(args: argparse.Namespace, settings: dict):
+    file_index = common.setup_index(settings)
+    transfer_queue = common.setup_transfer_queue(settings)
+    journal = plan.Journal(plan.journal_path(args.plan))
+    try:
+        stats = plan.apply(
+            plan.read_plan(args.plan),
+            journal,
+            transfer_queue,
+            functools.partial(_transfer_done, file_index, None),
+            logger,
+        )
+        transfer_queue.shutdown()
+    finally:
+        journal.close()
+    logger.info("Applied %s: %s", args.plan, ", ".join(f"{count} {name}" for name, count in stats.items()) or "nothing")
+    if file_index is not None:
+        file_index.close()
+
+
+def undo_plan(args: argparse.Namespace, settings: dict):
+    journal = plan.Journal(plan.journal_path(args.plan))
+    if not journal.path.exists():
+        logger.error("%s was never applied", args.plan)
+        return
+    restored = plan.undo(journal, logger)
+    file_index = common.setup_index(settings)
+    if file_index is not None:
+        # so the next run picks them up again
+        for source in restored:
+            file_index.forget(source)
+        file_index.close()
+    logger.info("Undid %s, %d files moved back", args.plan, len(restored))
+
+
+def organise(args: argparse.Namespace, settings: dict):
     tmdb_client = common.setup_tmdb_client(settings)
+    file_index = common.setup_index(settings)
+    parser = common.setup_parser(settings)
+    try:
+        common.setup_naming(settings)
+        transfer_queue = common.setup_transfer_queue(settings)
+        # outcomes and review entries are not kept in a dry run, the next real run would skip those files
+        review_queue = None if args.dry_run else common.setup_review_queue(args, settings)
+        library_index = common.setup_library(args.output, settings, logger)
+        planner = plan.PlanWriter(args.plan) if args.command == "plan" else None
+        min_confidence = args.min_confidence
+        if min_confidence is None:
+            min_confidence = settings.get("batch", {}).get("min_confidence", 0.85)
 
-    for file in common.iterate_inputs(args.input):
-        # TODO: try automatic process
-        # TODO: add option to force no input
-        # TODO: ask user validation / skip / manual
-        # TODO: if error or manual -> user interaction to edit incorrect data
+        if args.command == "watch":
+            # files already there go through the same settle check as new ones, they may still be downloading
+            watcher = common.setup_watcher(args.input, settings, logger, None if args.rescan else file_index)
+            batches = watcher.batches()
+        else:
+            files = common.iterate_inputs(
+                args.input,
+                logger,
+                **common.scan_options(settings),
+                file_index=None if args.rescan else file_index,
+            )
+            batches = [files]
+        guess_jobs = max(1, settings.get("parse", {}).get("processes", 0))
+
+        def _process(file: Path, media_info: Future):
+            # TODO: ask user validation / skip / manual
+            # TODO: if error or manual -> user interaction to edit incorrect data
+
+            try:
+                media_info = media_info.result()
+            except (MaybeInvalidMediaType, tmdb.MovieNotFound) as exc:
+                if args.batch:
+                    queue_for_review(review_queue, file, file_index, "not found", error=str(exc))
+                    return
+                logger.warning("Unable to identify %s automatically", file)
+                try:
+                    media_info = resolve_file(
+                        tmdb_client,
+                        file,
+                        forced_type=input("Media type (movie or episode): "),
+                        forced_title=input("Title: "),
+                        file_index=file_index,
+                    )
+                except (MaybeInvalidMediaType, tmdb.MovieNotFound) as exc:
+                    logger.error("Unable to identify %s: %s", file, exc)
+                    if file_index is not None and not args.dry_run:
+                        file_index.record(file, outcome="failed")
+                    return
 
-        try:
-            process_file(tmdb_client, args.output, file, args.preserve, args.dry_run)
-        except (MaybeInvalidMediaType, tmdb.MovieNotFound):
-            process_file(
+            if args.batch:
+                media_type, result, _ = media_info
+                # matches read from an NFO or confirmed for the same content before are trusted
+                confidence = 1.0
+                if not result.get("confirmed"):
+                    confidence = scoring.score_guess(common.guess_media(file, file_index), result)
+                if confidence < min_confidence:
+                    queue_for_review(
+                        review_queue,
+                        file,
+                        file_index,
+                        "low confidence",
+                        confidence=round(confidence, 3),
+                        media_type=media_type,
+                        tmdb_id=result["id"],
+                        title=result.get("title") or result.get("name"),
+                    )
+                    return
+                existing = library_index.find(
+                    media_type,
+                    result["id"],
+                    media_info[2].get("season_number"),
+                    media_info[2].get("episode_number"),
+                )
+                if existing:
+                    queue_for_review(
+                        review_queue,
+                        file,
+                        file_index,
+                        "already in library",
+                        existing=[str(path) for path in existing],
+                    )
+                    return
+                same_content = common.duplicates(file, file_index)
+                if same_content:
+                    queue_for_review(
+                        review_queue,
+                        file,
+                        file_index,
+                        "duplicate content",
+                        existing=[str(path) for path in same_content],
+                    )
+                    return
+                logger.info("Matched %s with confidence %.2f", file, confidence)
+
+            entry = plan_file(
                 tmdb_client,
                 args.output,
                 file,
+                media_info,
                 args.preserve,
                 args.dry_run,
-                forced_type=input("Media type (movie or episode): "),
-                forced_title=input("Title: "),
+                file_index,
+                interactive=not args.batch,
+                library_index=library_index,
             )
+            if entry is None:
+                return
+            if planner is not None:
+                planner.write(entry)
+                return
+            stat = file.stat()
+            future = plan.execute(entry, transfer_queue, logger)
+            future.add_done_callback(functools.partial(_transfer_done, file_index, library_index, entry, stat))
+
+        for files in batches:
+            for file, media_info in iterate_media_infos(tmdb_client, files, args.jobs, file_index, guess_jobs):
+                try:
+                    _process(file, media_info)
+                except (requests.RequestException, KeyError, OSError) as exc:
+                    # one file failing, TMDB unreachable or the file gone, must not stop a batch run or apollo watch
+                    logger.error("Unable to process %s: %s", file, exc)
+                    if args.batch and file.exists():
+                        queue_for_review(review_queue, file, file_index, "error", error=str(exc))
+
+        transfer_queue.shutdown()
+        if planner is not None:
+            planner.close()
+            logger.info("Wrote plan %s, run apollo apply %s to execute it", args.plan, args.plan)
+
+        logger.info(
+            "TMDB requests: %(hits)d cache hits, %(misses)d misses, %(coalesced)d coalesced, "
+            "%(offline)d offline matches",
+            tmdb_client.stats,
+        )
+    finally:
+        # the guessit workers are processes, they must not outlive an interrupted run
+        parser.shutdown()
+
+
+def run():
+    args = common.parse_args()
+    settings = common.load_settings(args, logger)
+    common.set_log_level(args, logger)
+    commands = {"titles": build_titles, "reindex": reindex, "apply": apply_plan, "undo": undo_plan}
+    profiler = common.setup_profiler(args)
+    try:
+        commands.get(args.command, organise)(args, settings)
+    finally:
+        common.report_metrics(args, settings, logger, profiler)
 
 
 if __name__ == "__main__":
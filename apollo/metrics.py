@@ -0,0 +1,149 @@
+import bisect
+import contextlib
+import functools
+import json
+import os
+import re
+import threading
+import time
+from pathlib import Path
+from typing import Callable, Iterator
+
+# upper bounds in seconds, doubling from 50µs to about 7 minutes
+BUCKETS = tuple(0.00005 * 2**power for power in range(24))
+
+
+class Histogram:
+    def __init__(self) -> None:
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect.bisect_left(BUCKETS, value)] += 1
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+
+    def quantile(self, q: float) -> float:
+        # upper bound of the bucket holding it, at most twice the real value
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(BUCKETS, self.counts):
+            seen += count
+            if seen >= rank:
+                return min(bound, self.max)
+        return self.max
+
+
+class Metrics:
+    # counters and timings of the hot paths, cheap enough to stay on and only reported with --profile or [metrics]
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self.counters: dict[str, float] = {}
+        self.histograms: dict[str, Histogram] = {}
+
+    def count(self, name: str, value: float = 1) -> None:
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def observe(self, name: str, seconds: float) -> None:
+        with self._lock:
+            if name not in self.histograms:
+                self.histograms[name] = Histogram()
+            self.histograms[name].observe(seconds)
+
+    @contextlib.contextmanager
+    def timer(self, name: str) -> Iterator[None]:
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start)
+
+    def timed(self, name: str) -> Callable:
+        def decorator(func: Callable) -> Callable:
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                with self.timer(name):
+                    return func(*args, **kwargs)
+
+            return wrapper
+
+        return decorator
+
+    def reset(self) -> None:
+        with self._lock:
+            self.counters.clear()
+            self.histograms.clear()
+
+    def summary(self) -> str:
+        with self._lock:
+            lines = [f"{'stage':<24}{'count':>8}{'total':>11}{'mean':>11}{'p50':>11}{'p95':>11}{'max':>11}"]
+            for name, histogram in sorted(self.histograms.items()):
+                lines.append(
+                    f"{name:<24}{histogram.count:>8}{histogram.sum:>10.3f}s"
+                    + "".join(
+                        f"{value * 1000:>9.2f}ms"
+                        for value in (
+                            histogram.sum / histogram.count,
+                            histogram.quantile(0.5),
+                            histogram.quantile(0.95),
+                            histogram.max,
+                        )
+                    )
+                )
+            lines.extend(f"{name:<24}{value:>8g}" for name, value in sorted(self.counters.items()))
+        return "\n".join(lines)
+
+    def to_dict(self) -> dict:
+        with self._lock:
+            return {
+                "counters": dict(self.counters),
+                "timers": {
+                    name: {
+                        "count": histogram.count,
+                        "sum": histogram.sum,
+                        "max": histogram.max,
+                        "p50": histogram.quantile(0.5),
+                        "p95": histogram.quantile(0.95),
+                    }
+                    for name, histogram in self.histograms.items()
+                },
+            }
+
+    def to_prometheus(self, prefix: str = "apollo") -> str:
+        # text exposition format, timers as histograms in seconds
+        lines = []
+        with self._lock:
+            for name, value in sorted(self.counters.items()):
+                metric = f"{prefix}_{_metric_name(name)}_total"
+                lines += [f"# TYPE {metric} counter", f"{metric} {value:g}"]
+            for name, histogram in sorted(self.histograms.items()):
+                metric = f"{prefix}_{_metric_name(name)}_seconds"
+                lines.append(f"# TYPE {metric} histogram")
+                cumulative = 0
+                for bound, count in zip(BUCKETS, histogram.counts):
+                    cumulative += count
+                    lines.append(f'{metric}_bucket{{le="{bound:g}"}} {cumulative}')
+                lines += [
+                    f'{metric}_bucket{{le="+Inf"}} {histogram.count}',
+                    f"{metric}_sum {histogram.sum:g}",
+                    f"{metric}_count {histogram.count}",
+                ]
+        return "\n".join(lines) + "\n"
+
+    def write(self, path: Path, prometheus: bool = False) -> None:
+        # through a temporary file, the node exporter must never read a half written one
+        path.parent.mkdir(exist_ok=True, parents=True)
+        temporary = path.with_name(f".{path.name}.{os.getpid()}")
+        temporary.write_text(self.to_prometheus() if prometheus else json.dumps(self.to_dict(), indent=2))
+        os.replace(temporary, path)
+
+
+def _metric_name(name: str) -> str:
+    return re.sub(r"[^a-zA-Z0-9_]", "_", name)
+
+
+default_metrics = Metrics()
@@ -0,0 +1,233 @@
+import functools
+import re
+import string
+from pathlib import Path
+from typing import Any, Callable
+
+MOVIE_TEMPLATE = "movie/{title} ({year}) [tmdbid-{tmdbid}]/{title} ({year}) [tmdbid-{tmdbid}]"
+EPISODE_TEMPLATE = (
+    "show/{show} ({year}) [tmdbid-{tmdbid}]/Season{season:02}/{show} S{season:02}E{episode:02} {episode_title}"
+)
+
+# characters refused by at least one of the filesystems a library usually ends up on
+REPLACEMENTS = {":": " -", "/": "-", "\\": "-", "|": "-", "?": "", "*": "", '"': "'", "<": "", ">": ""}
+
+_media_fields = {"title", "original_title", "year", "tmdbid", "show", "season", "episode", "episode_title"}
+# filled from probe.probe(), only probed when a template uses them
+_stream_fields = {"resolution", "video_codec", "audio_codec", "languages"}
+# the same for every episode of a show, folders only using these are show folders
+_show_fields = {"title", "original_title", "year", "tmdbid", "show"}
+# read back from existing names to know what a library file is
+_key_fields = {"tmdbid", "season", "episode"}
+
+_control_characters = dict.fromkeys(range(32))
+_empty_brackets = re.compile(r"\(\s*\)|\[\s*\]")
+_spaces = re.compile(r"\s+")
+_date = re.compile(r"(\d{4})-\d{2}-\d{2}")
+_whitespace = re.compile(r"(\s+)")
+
+
+@functools.lru_cache(maxsize=65536)
+def year(date: str | None) -> str:
+    # TMDB dates are YYYY-MM-DD, or empty when unknown
+    match = _date.match(date or "")
+    return match[1] if match else ""
+
+
+def resolution(width: int, height: int) -> str:
+    # by width too, so cropped 1920x800 films are still 1080p
+    for name, min_width, min_height in (("2160p", 3800, 2000), ("1080p", 1900, 1000), ("720p", 1260, 700)):
+        if width >= min_width or height >= min_height:
+            return name
+    return f"{height}p"
+
+
+def _literal(text: str) -> str:
+    # sanitizing collapses spaces and can drop them around empty fields
+    return "".join(r"\s*" if part.isspace() else re.escape(part) for part in _whitespace.split(text) if part)
+
+
+def _key_pattern(tokens: list[tuple[str, str | None]]) -> re.Pattern | None:
+    # from the text just before the first key field to the text just after the last one,
+    # other fields may be empty and take the brackets around them away when sanitized
+    keys = [position for position, (_, field) in enumerate(tokens) if field in _key_fields]
+    if not keys:
+        return None
+    pattern = ""
+    seen = set()
+    for position in range(keys[0], keys[-1] + 1):
+        literal, field = tokens[position]
+        if position == keys[0]:
+            literal = re.search(r"\S*\s*$", literal)[0]
+        pattern += _literal(literal)
+        if field in _key_fields:
+            pattern += f"(?P={field})" if field in seen else rf"(?P<{field}>\d+)"
+            seen.add(field)
+        elif field is not None:
+            pattern += ".*?"
+    following = tokens[keys[-1] + 1][0] if keys[-1] + 1 < len(tokens) else ""
+    return re.compile(pattern + _literal(re.match(r"\s*\S*", following)[0]))
+
+
+class Template:
+    # a "/" separated path pattern using str.format fields, parsed and checked once
+    def __init__(self, pattern: str) -> None:
+        self.pattern = pattern
+        self.components = tuple(component for component in pattern.split("/") if component)
+        if not self.components:
+            raise ValueError(f"Empty naming template {pattern!r}")
+        self.fields = set()
+        self._component_fields = []
+        self._keys = []
+        for component in self.components:
+            tokens = []
+            for literal, field, _, _ in string.Formatter().parse(component):
+                name = None
+                if field is not None:
+                    name = re.split(r"[.\[]", field, maxsplit=1)[0]
+                    if name not in _media_fields | _stream_fields:
+                        raise ValueError(f"Unknown field {{{field}}} in naming template {pattern!r}")
+                tokens.append((literal, name))
+            fields = {name for _, name in tokens if name is not None}
+            self.fields |= fields
+            self._component_fields.append(fields)
+            self._keys.append(_key_pattern(tokens))
+        self._formats = tuple(component.format_map for component in self.components)
+
+    @property
+    def show_depth(self) -> int:
+        # leading folders named after the show only, without the fieldless ones under them
+        depth = 0
+        for fields in self._component_fields[:-1]:
+            if not fields <= _show_fields:
+                break
+            depth += 1
+        while depth and not self._component_fields[depth - 1]:
+            depth -= 1
+        return depth
+
+    def key_values(self, names: list[str], sanitize: Callable[[str], str]) -> dict[str, int] | None:
+        # the key fields read back from the last path components, None when they do not follow this template
+        if len(names) < len(self.components):
+            return None
+        values = {}
+        for name, component, fields, key in zip(
+            names[-len(self.components) :], self.components, self._component_fields, self._keys
+        ):
+            if not fields and name != sanitize(component):
+                return None
+            if key is not None:
+                match = key.search(name)
+                if match is None:
+                    return None
+                values.update((field, int(value)) for field, value in match.groupdict().items())
+        return values
+
+    @property
+    def needs_streams(self) -> bool:
+        return bool(self.fields & _stream_fields)
+
+    def render(self, values: dict[str, Any]) -> list[str]:
+        return [format_component(values) for format_component in self._formats]
+
+
+class Naming:
+    def __init__(self) -> None:
+        self.configure({})
+
+    def configure(self, settings: dict[str, Any]) -> None:
+        self._templates = {
+            "movie": Template(settings.get("movie", MOVIE_TEMPLATE)),
+            "episode": Template(settings.get("episode", EPISODE_TEMPLATE)),
+        }
+        # in bytes, the usual limit for a single file or folder name
+        self._max_length = settings.get("max_length", 255)
+        self._replacements = str.maketrans({**REPLACEMENTS, **settings.get("replacements", {}), **_control_characters})
+        # titles repeat across episodes and folders across files
+        self.sanitize = functools.lru_cache(maxsize=65536)(self._sanitize)
+
+    def needs_streams(self, media_type: str) -> bool:
+        return self._templates[media_type].needs_streams
+
+    def show_folder(self, episode_file: Path) -> Path | None:
+        # the show folder of a file named by the episode template, None when shows have no folder of their own
+        template = self._templates["episode"]
+        depth = template.show_depth
+        if not depth:
+            return None
+        return episode_file.parents[len(template.components) - 1 - depth]
+
+    def media_key(self, path: Path | str) -> tuple | None:
+        # what a file named by the templates is, episodes first as the movie template only needs an id
+        names = list(Path(path).with_suffix("").parts)
+        values = self._templates["episode"].key_values(names, self.sanitize)
+        if values is not None and _key_fields <= values.keys():
+            return "episode", values["tmdbid"], values["season"], values["episode"]
+        values = self._templates["movie"].key_values(names, self.sanitize)
+        if values is not None and "tmdbid" in values:
+            return "movie", values["tmdbid"]
+        return None
+
+    def _sanitize(self, name: str, reserved: int = 0) -> str:
+        name = _spaces.sub(" ", _empty_brackets.sub("", name.translate(self._replacements))).strip()
+        encoded = name.encode()
+        if len(encoded) > self._max_length - reserved:
+            name = encoded[: self._max_length - reserved].decode("utf-8", "ignore")
+        # trailing dots and spaces are dropped by Windows and SMB shares
+        return name.rstrip(" .") or "_"
+
+    def values(
+        self,
+        media_type: str,
+        media_infos: dict,
+        extra_infos: dict,
+        streams: dict[str, Any] | None = None,
+    ) -> dict[str, Any]:
+        if media_type == "movie":
+            values = {
+                "title": media_infos["title"],
+                "original_title": media_infos.get("original_title", ""),
+                "year": year(media_infos.get("release_date")),
+            }
+        else:
+            values = {
+                "title": media_infos["name"],
+                "original_title": media_infos.get("original_name", ""),
+                "year": year(media_infos.get("first_air_date")),
+                "season": extra_infos["season_number"],
+                "episode": extra_infos["episode_number"],
+                "episode_title": extra_infos.get("name", ""),
+            }
+        values["show"] = values["title"]
+        values["tmdbid"] = media_infos["id"]
+
+        values.update(dict.fromkeys(_stream_fields, ""))
+        languages = []
+        for track in (streams or {}).get("tracks", ()):
+            if track["type"] == "video" and not values["video_codec"]:
+                values["video_codec"] = track["codec"]
+                if track.get("width") and track.get("height"):
+                    values["resolution"] = resolution(track["width"], track["height"])
+            elif track["type"] == "audio":
+                values["audio_codec"] = values["audio_codec"] or track["codec"]
+                if track["language"] and track["language"] not in languages:
+                    languages.append(track["language"])
+        values["languages"] = "+".join(languages)
+        return values
+
+    def path(
+        self,
+        media_type: str,
+        media_infos: dict,
+        extra_infos: dict,
+        suffix: str,
+        streams: dict[str, Any] | None = None,
+    ) -> list[str]:
+        # path components relative to the output folder, the last one being the file name
+        components = self._templates[media_type].render(self.values(media_type, media_infos, extra_infos, streams))
+        names = [self.sanitize(component) for component in components[:-1]]
+        names.append(self.sanitize(components[-1], len(suffix.encode())) + suffix)
+        return names
+
+
+default_naming = Naming()
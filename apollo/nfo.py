@@ -1,36 +1,143 @@
-import datetime
+import functools
 from pathlib import Path
-from xml.etree import ElementTree as ET
+from typing import Any, Iterable, TextIO
+from xml.etree.ElementTree import ParseError
+from xml.sax.saxutils import escape
 
+from defusedxml import DefusedXmlException
+from defusedxml.ElementTree import iterparse
 
-def parse_nfo(nfo_file: Path):
+from apollo.metrics import default_metrics
+
+_declaration = '<?xml version="1.0" encoding="utf-8" standalone="yes"?>\n'
+
+# only these top level elements are read back, actors, art and stream details are skipped
+_read = frozenset({"title", "originaltitle", "showtitle", "year", "tmdbid", "season", "episode"})
+
+
+class InvalidNfo(Exception):
     pass
 
-def create_nfo(
-    title: str,
-    original_title: str,
-    plot: str,
-    tmdbid: str,
-    year: str,
-    output: Path,
-):
-    root = ET.Element("movie")
-    ET.SubElement(root, "title").text = title
-    ET.SubElement(root, "originaltitle").text = original_title
-    ET.SubElement(root, "plot").text = plot
-    ET.SubElement(root, "year").text = year
-    ET.SubElement(root, "tmdbid").text = tmdbid
-    ET.SubElement(root, "lockdata").text = "true"
-    tree = ET.ElementTree(root)
-    ET.indent(tree)
-    ET.dump(tree)
-    tree.write(
-        output, encoding="utf-8", xml_declaration=True, short_empty_elements=False
-    )
+
+class NfoWriter:
+    # writes elements to the file as they come instead of building the whole tree first
+    def __init__(self, output_file: TextIO) -> None:
+        self._file = output_file
+        self._tags: list[str] = []
+
+    def start(self, tag: str) -> None:
+        self._file.write(f"{'  ' * len(self._tags)}<{tag}>\n")
+        self._tags.append(tag)
+
+    def element(self, tag: str, text: Any) -> None:
+        text = "" if text is None else escape(str(text))
+        self._file.write(f"{'  ' * len(self._tags)}<{tag}>{text}</{tag}>\n")
+
+    def end(self) -> None:
+        tag = self._tags.pop()
+        self._file.write(f"{'  ' * len(self._tags)}</{tag}>\n")
+
+    def elements(self, fields: Iterable[tuple[str, Any]]) -> None:
+        # a list value is a nested element
+        for tag, value in fields:
+            if isinstance(value, list):
+                self.start(tag)
+                self.elements(value)
+                self.end()
+            else:
+                self.element(tag, value)
+
+
+@default_metrics.timed("nfo.write")
+def create_nfo(root: str, fields: Iterable[tuple[str, Any]], output: Path) -> None:
+    # root is movie, tvshow or episodedetails
+    with open(output, "w", encoding="utf-8") as output_file:
+        output_file.write(_declaration)
+        writer = NfoWriter(output_file)
+        writer.start(root)
+        writer.elements(fields)
+        writer.end()
+
+
+def fileinfo(streams: dict[str, Any]) -> tuple[str, list]:
+    # <fileinfo><streamdetails> from probe.probe()
+    details = []
+    for track in streams["tracks"]:
+        fields = [("codec", track["codec"])]
+        if track["type"] == "video":
+            fields += [("width", track.get("width")), ("height", track.get("height"))]
+            if streams["duration"] is not None:
+                fields += [
+                    ("duration", int(streams["duration"] // 60)),
+                    ("durationinseconds", round(streams["duration"])),
+                ]
+        else:
+            fields.append(("language", track["language"]))
+        if track["type"] == "audio":
+            fields += [("channels", track.get("channels")), ("samplingrate", track.get("samplingrate"))]
+        fields += [("default", track["default"]), ("forced", track["forced"])]
+        details.append((track["type"], fields))
+    return "fileinfo", [("streamdetails", details)]
+
+
+def parse_nfo(nfo_file: Path) -> dict[str, str]:
+    data = {}
+    depth = 0
+    try:
+        for event, element in iterparse(nfo_file, events=("start", "end")):
+            if event == "start":
+                if depth == 0:
+                    data["type"] = element.tag
+                depth += 1
+                continue
+            depth -= 1
+            if depth == 1:
+                if element.tag in _read and element.tag not in data and element.text:
+                    data[element.tag] = element.text.strip()
+                elif element.tag == "uniqueid" and element.get("type") == "tmdb" and element.text:
+                    data.setdefault("uniqueid", element.text.strip())
+                # keep memory flat on big files
+                element.clear()
+    except (ParseError, DefusedXmlException, OSError) as exc:
+        raise InvalidNfo(f"Unable to read {nfo_file}: {exc}") from exc
+    return data
+
+
+def tmdbid(data: dict[str, str]) -> int | None:
+    value = data.get("tmdbid") or data.get("uniqueid")
+    return int(value) if value and value.isdigit() else None
+
+
+@functools.lru_cache(maxsize=1024)
+def show_tmdbid(directory: Path) -> int | None:
+    # episodes sit in the show folder or in one of its season folders
+    for folder in (directory, directory.parent):
+        show_nfo = folder / "tvshow.nfo"
+        if show_nfo.is_file():
+            try:
+                return tmdbid(parse_nfo(show_nfo))
+            except InvalidNfo:
+                return None
+    return None
+
+
+def identify(nfo_file: Path) -> tuple[str, int, int | None, int | None] | None:
+    # media type, TMDB id (the show's for episodes), season and episode known from an existing NFO
+    data = parse_nfo(nfo_file)
+    if data["type"] == "movie":
+        movie_id = tmdbid(data)
+        return ("movie", movie_id, None, None) if movie_id is not None else None
+    if data["type"] == "episodedetails":
+        show_id = show_tmdbid(nfo_file.parent)
+        if show_id is None or not data.get("season", "").isdigit() or not data.get("episode", "").isdigit():
+            return None
+        return "episode", show_id, int(data["season"]), int(data["episode"])
+    return None
 
 
 if __name__ == "__main__":
-    create_nfo("Tenet", "Tenet", "", "", "", Path("test.nfo"))
+    create_nfo("movie", [("title", "Tenet"), ("originaltitle", "Tenet"), ("tmdbid", "577922")], Path("test.nfo"))
+    print(parse_nfo(Path("test.nfo")))
 
 """
 <?xml version="1.0" encoding="utf-8" standalone="yes"?>
@@ -0,0 +1,91 @@
+import gzip
+import json
+import sqlite3
+import threading
+from pathlib import Path
+from typing import Any, Iterator
+
+from apollo import scoring
+
+# key holding the title in TMDB's daily export files
+_title_keys = {"movie": "original_title", "tv": "original_name"}
+
+
+class OfflineIndex:
+    # full text index of the titles listed in TMDB's daily ID exports
+    def __init__(self, path: Path | str) -> None:
+        if path != ":memory:":
+            Path(path).parent.mkdir(exist_ok=True, parents=True)
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._db.execute("PRAGMA mmap_size=268435456")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS titles ("
+            "media_type TEXT NOT NULL, id INTEGER NOT NULL, title TEXT NOT NULL, popularity REAL NOT NULL, "
+            "PRIMARY KEY (media_type, id))"
+        )
+        self._db.execute(
+            "CREATE VIRTUAL TABLE IF NOT EXISTS titles_fts USING fts5("
+            "title, content='titles', tokenize='unicode61 remove_diacritics 2')"
+        )
+
+    def build(self, entries: Iterator[dict[str, Any]], media_type: str, batch_size: int = 10000) -> int:
+        title_key = _title_keys[media_type]
+        count = 0
+        with self._lock:
+            self._db.execute("BEGIN")
+            self._db.execute("DELETE FROM titles WHERE media_type = ?", (media_type,))
+            batch = []
+            for entry in entries:
+                if entry.get("adult") or entry.get("video") or not entry.get(title_key):
+                    continue
+                batch.append((media_type, entry["id"], entry[title_key], entry.get("popularity", 0)))
+                if len(batch) >= batch_size:
+                    self._db.executemany("INSERT OR REPLACE INTO titles VALUES (?, ?, ?, ?)", batch)
+                    count += len(batch)
+                    batch = []
+            self._db.executemany("INSERT OR REPLACE INTO titles VALUES (?, ?, ?, ?)", batch)
+            count += len(batch)
+            self._db.execute("INSERT INTO titles_fts (titles_fts) VALUES ('rebuild')")
+            self._db.execute("COMMIT")
+        return count
+
+    def search(self, query: str, media_type: str, limit: int = 50) -> list[dict[str, Any]]:
+        tokens = scoring.normalize_title(query).split()
+        if not tokens:
+            return []
+        title_key = _title_keys[media_type]
+        rows = []
+        # every word first, any word when that finds nothing
+        for operator in (" AND ", " OR "):
+            match = operator.join(f'"{token}"' for token in tokens)
+            with self._lock:
+                rows = self._db.execute(
+                    "SELECT titles.id, titles.title, titles.popularity FROM titles_fts "
+                    "JOIN titles ON titles.rowid = titles_fts.rowid "
+                    "WHERE titles_fts MATCH ? AND titles.media_type = ? ORDER BY bm25(titles_fts) LIMIT ?",
+                    (match, media_type, limit),
+                ).fetchall()
+            if rows or len(tokens) == 1:
+                break
+        return [{"id": id, title_key: title, "popularity": popularity} for id, title, popularity in rows]
+
+    def close(self) -> None:
+        with self._lock:
+            self._db.close()
+
+
+def read_export(export_file: Path) -> Iterator[dict[str, Any]]:
+    opener = gzip.open if export_file.suffix == ".gz" else open
+    with opener(export_file, "rt", encoding="utf-8") as lines:
+        for line in lines:
+            if line.strip():
+                yield json.loads(line)
+
+
+def export_media_type(export_file: Path) -> str:
+    if export_file.name.startswith("movie_ids"):
+        return "movie"
+    if export_file.name.startswith("tv_series_ids"):
+        return "tv"
+    raise ValueError(f"Unable to tell the media type of {export_file}")
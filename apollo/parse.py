@@ -0,0 +1,63 @@
+import collections
+import os
+import signal
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+import guessit
+
+from apollo.metrics import default_metrics
+
+
+def _warm() -> None:
+    # Ctrl-C is for the main process, which then shuts the pool down (apollo watch is stopped that way)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    # guessit builds its rebulk rules on first use, pay for it once per worker
+    guessit.guessit("Warm.Up.S01E01.2000.1080p.WEB.x264-GRP.mkv")
+
+
+def _guess(name: str) -> dict:
+    return dict(guessit.guessit(name))
+
+
+class Parser:
+    def __init__(self, maxsize: int = 65536) -> None:
+        self._maxsize = maxsize
+        self._memo: collections.OrderedDict[str, dict] = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self._pool: ProcessPoolExecutor | None = None
+
+    def start(self, processes: int) -> None:
+        if processes > 0 and self._pool is None:
+            self._pool = ProcessPoolExecutor(processes, initializer=_warm)
+
+    def shutdown(self) -> None:
+        if self._pool is not None:
+            self._pool.shutdown(cancel_futures=True)
+            self._pool = None
+
+    def _get(self, name: str) -> dict | None:
+        with self._lock:
+            guess = self._memo.get(name)
+            if guess is not None:
+                self._memo.move_to_end(name)
+            return guess
+
+    def _put(self, name: str, guess: dict) -> None:
+        with self._lock:
+            self._memo[name] = guess
+            if len(self._memo) > self._maxsize:
+                self._memo.popitem(last=False)
+
+    def guess(self, file: Path | str) -> dict:
+        name = os.fspath(file)
+        guess = self._get(name)
+        if guess is None:
+            with default_metrics.timer("parse.guessit"):
+                guess = self._pool.submit(_guess, name).result() if self._pool is not None else _guess(name)
+            self._put(name, guess)
+        return dict(guess)
+
+
+default_parser = Parser()
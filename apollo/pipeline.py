@@ -0,0 +1,49 @@
+import collections
+import queue
+import threading
+from concurrent.futures import Executor, Future
+from typing import Any, Callable, Iterable, Iterator
+
+_done = object()
+
+
+def call(func: Callable, *args, **kwargs) -> Future:
+    # run synchronously but hand back a future, so serial and concurrent paths look the same
+    future = Future()
+    try:
+        future.set_result(func(*args, **kwargs))
+    except Exception as exc:
+        future.set_exception(exc)
+    return future
+
+
+def prefetch(iterable: Iterable, maxsize: int) -> Iterator:
+    # consume iterable from a background thread, at most maxsize items ahead of the caller
+    items = queue.Queue(maxsize)
+    errors = []
+
+    def _produce():
+        try:
+            for item in iterable:
+                items.put(item)
+        except Exception as exc:
+            errors.append(exc)
+        finally:
+            items.put(_done)
+
+    threading.Thread(target=_produce, daemon=True).start()
+    while (item := items.get()) is not _done:
+        yield item
+    if errors:
+        raise errors[0]
+
+
+def ordered_map(executor: Executor, func: Callable, iterable: Iterable, window: int) -> Iterator[tuple[Any, Future]]:
+    # submit func for each item and yield (item, future) in input order, with at most window items in flight
+    pending = collections.deque()
+    for item in iterable:
+        pending.append((item, executor.submit(func, item)))
+        if len(pending) >= window:
+            yield pending.popleft()
+    while pending:
+        yield pending.popleft()
@@ -0,0 +1,295 @@
+import collections
+import functools
+import itertools
+import json
+import os
+import threading
+from concurrent.futures import Future
+from pathlib import Path
+from typing import Any, Callable, Iterable, Iterator
+
+from apollo import nfo, transfer
+
+# one JSON object per planned file:
+# source, destination, move, media_type, tmdb_id, season, episode, fingerprint, size, mtime_ns,
+# match: the (media_type, result, extra_infos) remembered for the fingerprint once transferred,
+# nfos: [path, root, fields, overwrite] for each NFO to write next to it
+
+
+class PlanWriter:
+    def __init__(self, path: Path) -> None:
+        path.parent.mkdir(exist_ok=True, parents=True)
+        self._lock = threading.Lock()
+        self._file = open(path, "w", encoding="utf-8")
+
+    def write(self, entry: dict[str, Any]) -> None:
+        line = json.dumps(entry, separators=(",", ":"), default=str)
+        with self._lock:
+            self._file.write(line + "\n")
+
+    def close(self) -> None:
+        with self._lock:
+            self._file.close()
+
+
+def read_plan(path: Path) -> Iterator[dict[str, Any]]:
+    with open(path, encoding="utf-8") as plan_file:
+        for line in plan_file:
+            if line.strip():
+                yield json.loads(line)
+
+
+def journal_path(plan_path: Path) -> Path:
+    return plan_path.with_name(plan_path.name + ".journal")
+
+
+def write_nfos(entry: dict[str, Any], on_write: Callable[[Path, str | None], None] | None = None) -> None:
+    # on_write gets what an NFO contained before being replaced, None when it is created
+    for path, root, fields, overwrite in entry["nfos"]:
+        path = Path(path)
+        exists = path.exists()
+        if exists and not overwrite:
+            continue
+        if on_write is not None:
+            on_write(path, path.read_text(encoding="utf-8") if exists else None)
+        nfo.create_nfo(root, fields, path)
+
+
+def _write_nfos_after(
+    entry: dict[str, Any], logger, on_write: Callable[[Path, str | None], None] | None, future: Future
+) -> None:
+    # only once the media file is in place, a refused transfer must leave the NFOs already there alone
+    if future.exception() is not None:
+        return
+    try:
+        write_nfos(entry, on_write)
+    except OSError as exc:
+        logger.error("Unable to write the NFOs of %s: %s", entry["destination"], exc)
+
+
+def execute(entry: dict[str, Any], transfer_queue: transfer.TransferQueue, logger) -> Future:
+    # without journal, for files processed as soon as they are identified
+    Path(entry["destination"]).parent.mkdir(exist_ok=True, parents=True)
+    future = transfer_queue.submit(Path(entry["source"]), Path(entry["destination"]), move=entry["move"])
+    future.add_done_callback(functools.partial(_write_nfos_after, entry, logger, None))
+    return future
+
+
+class Journal:
+    # write-ahead log of apply: intents are synced to disk before touching files, and completed
+    # operations are what undo reverts
+    def __init__(self, path: Path) -> None:
+        self.path = path
+        self._lock = threading.Lock()
+        self._file = None
+
+    def load(self) -> list[dict[str, Any]]:
+        if not self.path.exists():
+            return []
+        records = []
+        with open(self.path, "r+b") as journal_file:
+            valid = 0
+            for line in journal_file:
+                try:
+                    records.append(json.loads(line))
+                except json.JSONDecodeError:
+                    # last line cut short by a crash, dropped so new records start on their own line
+                    journal_file.truncate(valid)
+                    break
+                valid += len(line)
+        return records
+
+    def write(self, *records: dict[str, Any], sync: bool = False) -> None:
+        lines = "".join(json.dumps(record, separators=(",", ":")) + "\n" for record in records)
+        with self._lock:
+            if self._file is None:
+                self._file = open(self.path, "a", encoding="utf-8")
+            self._file.write(lines)
+            self._file.flush()
+            if sync:
+                os.fsync(self._file.fileno())
+
+    def close(self) -> None:
+        with self._lock:
+            if self._file is not None:
+                os.fsync(self._file.fileno())
+                self._file.close()
+                self._file = None
+
+
+def _finished(begin: dict[str, Any], created: bool) -> bool:
+    # whether an operation interrupted by a crash had completed, partial copies are removed
+    source, destination = Path(begin["source"]), Path(begin["destination"])
+    if not destination.exists():
+        return False
+    if begin["move"] and not source.exists():
+        return True
+    if not created:
+        # not written by apply, apply skips it as already existing
+        return False
+    if not begin["move"] and source.stat().st_size == destination.stat().st_size:
+        return True
+    destination.unlink()
+    return False
+
+
+def recover(journal: Journal) -> set[str]:
+    # destinations done, including those interrupted after completing
+    states = {}
+    begun = {}
+    for record in journal.load():
+        if record["op"] in ("begin", "created", "done", "failed"):
+            states[record["destination"]] = record["op"]
+        if record["op"] == "begin":
+            begun[record["destination"]] = record
+    for destination, state in states.items():
+        if state in ("begin", "created") and _finished(begun[destination], state == "created"):
+            journal.write({"op": "done", "destination": destination, "method": "recovered"})
+            states[destination] = "done"
+    return {destination for destination, state in states.items() if state == "done"}
+
+
+def _missing_directories(directory: Path) -> list[Path]:
+    missing = []
+    while not directory.exists():
+        missing.append(directory)
+        directory = directory.parent
+    return missing[::-1]
+
+
+def apply(
+    entries: Iterable[dict[str, Any]],
+    journal: Journal,
+    transfer_queue: transfer.TransferQueue,
+    on_done: Callable[[dict[str, Any], os.stat_result, Future], None],
+    logger,
+) -> collections.Counter:
+    stats = collections.Counter()
+    done = recover(journal)
+
+    pending = []
+    destinations = set()
+    for entry in entries:
+        if entry["destination"] in done:
+            stats["already applied"] += 1
+            continue
+        if entry["destination"] in destinations:
+            # the second transfer would replace the first file
+            logger.warning("%s is planned more than once, skipping %s", entry["destination"], entry["source"])
+            stats["duplicate"] += 1
+            continue
+        destinations.add(entry["destination"])
+        try:
+            stat = os.stat(entry["source"])
+        except FileNotFoundError:
+            logger.warning("%s is gone, skipping it", entry["source"])
+            stats["missing"] += 1
+            continue
+        if (stat.st_size, stat.st_mtime_ns) != (entry["size"], entry["mtime_ns"]):
+            logger.warning("%s changed since it was planned, skipping it", entry["source"])
+            stats["changed"] += 1
+            continue
+        if os.path.lexists(entry["destination"]):
+            logger.warning("%s already exists, skipping %s", entry["destination"], entry["source"])
+            stats["exists"] += 1
+            continue
+        pending.append((entry, stat))
+
+    def destination_folder(planned: tuple[dict[str, Any], os.stat_result]) -> str:
+        return os.path.dirname(planned[0]["destination"])
+
+    # all folders at once, then one journal sync per destination folder
+    pending.sort(key=destination_folder)
+    created = list(
+        dict.fromkeys(
+            directory
+            for folder in sorted({destination_folder(planned) for planned in pending})
+            for directory in _missing_directories(Path(folder))
+        )
+    )
+    if created:
+        journal.write(*({"op": "mkdir", "path": str(directory)} for directory in created), sync=True)
+        for directory in created:
+            directory.mkdir(exist_ok=True)
+
+    def _nfo_written(path: Path, previous: str | None) -> None:
+        # synced, the previous content is only kept here
+        journal.write({"op": "nfo", "path": str(path), "previous": previous}, sync=previous is not None)
+
+    lock = threading.Lock()
+
+    for _, group in itertools.groupby(pending, key=destination_folder):
+        group = list(group)
+        journal.write(
+            *(
+                {"op": "begin", "source": entry["source"], "destination": entry["destination"], "move": entry["move"]}
+                for entry, _ in group
+            ),
+            sync=True,
+        )
+        for entry, stat in group:
+            future = transfer_queue.submit(
+                Path(entry["source"]),
+                Path(entry["destination"]),
+                move=entry["move"],
+                created=functools.partial(journal.write, {"op": "created", "destination": entry["destination"]}),
+            )
+            future.add_done_callback(
+                functools.partial(_applied, journal, stats, lock, entry, stat, on_done, _nfo_written, logger)
+            )
+    # counts are final once the transfer queue is shut down
+    return stats
+
+
+def _applied(
+    journal: Journal,
+    stats: collections.Counter,
+    lock: threading.Lock,
+    entry: dict[str, Any],
+    stat: os.stat_result,
+    on_done,
+    on_nfo_written: Callable[[Path, str | None], None],
+    logger,
+    future: Future,
+) -> None:
+    _write_nfos_after(entry, logger, on_nfo_written, future)
+    if future.exception() is None:
+        journal.write({"op": "done", "destination": entry["destination"], "method": future.result().method})
+    else:
+        journal.write({"op": "failed", "destination": entry["destination"], "error": str(future.exception())})
+    with lock:
+        stats["applied" if future.exception() is None else "failed"] += 1
+    on_done(entry, stat, future)
+
+
+def undo(journal: Journal, logger) -> list[Path]:
+    # reverts completed operations, newest first, and returns the restored sources
+    records = journal.load()
+    begun = {record["destination"]: record for record in records if record["op"] == "begin"}
+    restored = []
+    for record in reversed(records):
+        if record["op"] == "done":
+            begin = begun[record["destination"]]
+            source, destination = Path(begin["source"]), Path(begin["destination"])
+            if not begin["move"]:
+                destination.unlink(missing_ok=True)
+                continue
+            if source.exists() or not destination.exists():
+                logger.warning("Unable to move %s back to %s", destination, source)
+                continue
+            source.parent.mkdir(exist_ok=True, parents=True)
+            transfer.transfer(destination, source, move=True)
+            restored.append(source)
+        elif record["op"] == "nfo":
+            if record["previous"] is None:
+                Path(record["path"]).unlink(missing_ok=True)
+            else:
+                Path(record["path"]).write_text(record["previous"], encoding="utf-8")
+        elif record["op"] == "mkdir":
+            try:
+                Path(record["path"]).rmdir()
+            except OSError:
+                # not empty, something else was put there
+                pass
+    journal.path.rename(journal.path.with_name(journal.path.name + ".undone"))
+    return restored
@@ -0,0 +1,41 @@
+import collections
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Callable, Hashable, Iterable
+
+
+class Prefetcher:
+    # computes func(item) ahead of time for items likely to be needed soon, keeping at most max_size results
+    def __init__(self, func: Callable[[Any], Any], workers: int = 2, max_size: int = 32) -> None:
+        self._func = func
+        self._max_size = max_size
+        self._pool = ThreadPoolExecutor(workers, thread_name_prefix="prefetch")
+        self._lock = threading.Lock()
+        self._futures: collections.OrderedDict[Hashable, Future] = collections.OrderedDict()
+
+    def prefetch(self, items: Iterable[Hashable]) -> None:
+        with self._lock:
+            for item in items:
+                if item in self._futures:
+                    self._futures.move_to_end(item)
+                    continue
+                self._futures[item] = self._pool.submit(self._func, item)
+                while len(self._futures) > self._max_size:
+                    _, oldest = self._futures.popitem(last=False)
+                    oldest.cancel()
+
+    def get(self, item: Hashable) -> Future | None:
+        with self._lock:
+            future = self._futures.get(item)
+        if future is None or future.cancelled():
+            return None
+        return future
+
+    def discard(self, item: Hashable) -> None:
+        with self._lock:
+            future = self._futures.pop(item, None)
+        if future is not None:
+            future.cancel()
+
+    def shutdown(self) -> None:
+        self._pool.shutdown(wait=False, cancel_futures=True)
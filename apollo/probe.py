@@ -0,0 +1,301 @@
+import os
+import struct
+from pathlib import Path
+from typing import Any, Iterator
+
+# bodies read whole are small: headers, track lists, sample descriptions
+MAX_ELEMENT_SIZE = 4 * 1024 * 1024
+
+# Matroska / EBML element ids
+_EBML = 0x1A45DFA3
+_SEGMENT = 0x18538067
+_SEEK_HEAD = 0x114D9B74
+_SEEK = 0x4DBB
+_SEEK_ID = 0x53AB
+_SEEK_POSITION = 0x53AC
+_INFO = 0x1549A966
+_TIMESTAMP_SCALE = 0x2AD7B1
+_DURATION = 0x4489
+_TRACKS = 0x1654AE6B
+_TRACK_ENTRY = 0xAE
+_TRACK_TYPE = 0x83
+_CODEC_ID = 0x86
+_LANGUAGE = 0x22B59C
+_LANGUAGE_BCP47 = 0x22B59D
+_FLAG_DEFAULT = 0x88
+_FLAG_FORCED = 0x55AA
+_VIDEO = 0xE0
+_PIXEL_WIDTH = 0xB0
+_PIXEL_HEIGHT = 0xBA
+_AUDIO = 0xE1
+_SAMPLING_FREQUENCY = 0xB5
+_CHANNELS = 0x9F
+_CLUSTER = 0x1F43B675
+
+_matroska_track_types = {1: "video", 2: "audio", 17: "subtitle"}
+_matroska_codecs = {
+    "V_MPEG4/ISO/AVC": "h264",
+    "V_MPEGH/ISO/HEVC": "hevc",
+    "V_AV1": "av1",
+    "V_VP8": "vp8",
+    "V_VP9": "vp9",
+    "V_MPEG2": "mpeg2video",
+    "V_MPEG4/ISO/ASP": "mpeg4",
+    "A_AAC": "aac",
+    "A_AC3": "ac3",
+    "A_EAC3": "eac3",
+    "A_DTS": "dts",
+    "A_TRUEHD": "truehd",
+    "A_OPUS": "opus",
+    "A_FLAC": "flac",
+    "A_VORBIS": "vorbis",
+    "A_MPEG/L3": "mp3",
+    "S_TEXT/UTF8": "srt",
+    "S_TEXT/ASS": "ass",
+    "S_TEXT/SSA": "ssa",
+    "S_HDMV/PGS": "pgssub",
+    "S_VOBSUB": "dvdsub",
+}
+
+_mp4_handlers = {b"vide": "video", b"soun": "audio", b"subt": "subtitle", b"text": "subtitle", b"sbtl": "subtitle"}
+_mp4_codecs = {
+    b"avc1": "h264",
+    b"avc3": "h264",
+    b"hvc1": "hevc",
+    b"hev1": "hevc",
+    b"av01": "av1",
+    b"vp09": "vp9",
+    b"mp4v": "mpeg4",
+    b"mp4a": "aac",
+    b"ac-3": "ac3",
+    b"ec-3": "eac3",
+    b"Opus": "opus",
+    b"fLaC": "flac",
+    b"tx3g": "mov_text",
+}
+# boxes holding the ones we read, everything else is skipped by its size
+_mp4_containers = {b"moov", b"trak", b"mdia", b"minf", b"stbl"}
+
+
+class ProbeError(Exception):
+    pass
+
+
+def _read(fd: int, size: int, offset: int) -> bytes:
+    if size > MAX_ELEMENT_SIZE:
+        raise ProbeError(f"Element of {size} bytes at {offset} is too big for a header")
+    data = os.pread(fd, size, offset)
+    if len(data) < size:
+        raise ProbeError(f"Truncated file at {offset}")
+    return data
+
+
+def _vint(data: bytes, position: int, keep_marker: bool) -> tuple[int | None, int]:
+    # EBML variable size integer: the number of leading zero bits gives its length
+    first = data[position]
+    length = 8 - first.bit_length() + 1
+    if first == 0 or length > 8:
+        raise ProbeError("Invalid EBML integer")
+    value = first if keep_marker else first & (0xFF >> length)
+    for byte in data[position + 1 : position + length]:
+        value = (value << 8) | byte
+    if not keep_marker and value == (1 << (7 * length)) - 1:
+        # all ones, size unknown until the parent ends
+        return None, length
+    return value, length
+
+
+def _ebml_header(data: bytes, position: int = 0) -> tuple[int, int | None, int]:
+    element_id, id_length = _vint(data, position, keep_marker=True)
+    size, size_length = _vint(data, position + id_length, keep_marker=False)
+    return element_id, size, id_length + size_length
+
+
+def _ebml_children(data: bytes) -> Iterator[tuple[int, bytes]]:
+    position = 0
+    while position < len(data):
+        element_id, size, header_length = _ebml_header(data, position)
+        start = position + header_length
+        end = len(data) if size is None else start + size
+        yield element_id, data[start:end]
+        position = end
+
+
+def _uint(data: bytes) -> int:
+    return int.from_bytes(data, "big")
+
+
+def _float(data: bytes) -> float:
+    return struct.unpack(">f" if len(data) == 4 else ">d", data)[0]
+
+
+def _string(data: bytes) -> str:
+    return data.rstrip(b"\0").decode("utf-8", "replace")
+
+
+def _matroska_track(entry: bytes) -> dict[str, Any] | None:
+    fields = dict(_ebml_children(entry))
+    kind = _matroska_track_types.get(_uint(fields.get(_TRACK_TYPE, b"")))
+    if kind is None:
+        return None
+    codec = _string(fields.get(_CODEC_ID, b""))
+    track = {
+        "type": kind,
+        "codec": _matroska_codecs.get(codec, _matroska_codecs.get(codec.split("/")[0], codec.lower())),
+        # Matroska's default language is English
+        "language": _string(fields.get(_LANGUAGE_BCP47) or fields.get(_LANGUAGE) or b"eng"),
+        "default": bool(_uint(fields.get(_FLAG_DEFAULT, b"\x01"))),
+        "forced": bool(_uint(fields.get(_FLAG_FORCED, b"\x00"))),
+    }
+    if kind == "video" and _VIDEO in fields:
+        video = dict(_ebml_children(fields[_VIDEO]))
+        track["width"] = _uint(video.get(_PIXEL_WIDTH, b""))
+        track["height"] = _uint(video.get(_PIXEL_HEIGHT, b""))
+    elif kind == "audio" and _AUDIO in fields:
+        audio = dict(_ebml_children(fields[_AUDIO]))
+        track["channels"] = _uint(audio.get(_CHANNELS, b"\x01"))
+        if _SAMPLING_FREQUENCY in audio:
+            track["samplingrate"] = int(_float(audio[_SAMPLING_FREQUENCY]))
+    return track
+
+
+def _probe_matroska(fd: int, size: int) -> dict[str, Any]:
+    header = _read(fd, min(size, 64), 0)
+    _, ebml_size, header_length = _ebml_header(header)
+    if ebml_size is None:
+        raise ProbeError("EBML header of unknown size")
+    position = header_length + ebml_size
+    segment_id, segment_size, header_length = _ebml_header(_read(fd, min(size - position, 12), position))
+    if segment_id != _SEGMENT:
+        raise ProbeError("No Matroska segment")
+    segment_start = position + header_length
+    segment_end = size if segment_size is None else min(size, segment_start + segment_size)
+
+    # walk the top level elements by their sizes until the first cluster
+    wanted = {_INFO, _TRACKS}
+    found = {}
+    seeks = {}
+    position = segment_start
+    while position < segment_end - 2 and wanted - found.keys():
+        element_id, element_size, header_length = _ebml_header(_read(fd, min(segment_end - position, 12), position))
+        if element_id == _CLUSTER or element_size is None:
+            break
+        if element_id in wanted:
+            found[element_id] = _read(fd, element_size, position + header_length)
+        elif element_id == _SEEK_HEAD:
+            for child_id, seek in _ebml_children(_read(fd, element_size, position + header_length)):
+                if child_id == _SEEK:
+                    fields = dict(_ebml_children(seek))
+                    seeks[_uint(fields.get(_SEEK_ID, b""))] = segment_start + _uint(fields.get(_SEEK_POSITION, b""))
+        position += header_length + element_size
+
+    # the ones stored after the clusters are found through the seek head
+    for element_id in wanted - found.keys():
+        if element_id in seeks:
+            position = seeks[element_id]
+            found_id, element_size, header_length = _ebml_header(_read(fd, min(size - position, 12), position))
+            if found_id == element_id and element_size is not None:
+                found[element_id] = _read(fd, element_size, position + header_length)
+
+    info = dict(_ebml_children(found.get(_INFO, b"")))
+    duration = None
+    if _DURATION in info:
+        timestamp_scale = _uint(info.get(_TIMESTAMP_SCALE, b"")) or 1_000_000
+        duration = _float(info[_DURATION]) * timestamp_scale / 1e9
+    entries = [entry for entry_id, entry in _ebml_children(found.get(_TRACKS, b"")) if entry_id == _TRACK_ENTRY]
+    tracks = [_matroska_track(entry) for entry in entries]
+    return {"container": "matroska", "duration": duration, "tracks": [track for track in tracks if track is not None]}
+
+
+def _mp4_boxes(fd: int, start: int, end: int) -> Iterator[tuple[bytes, int, int]]:
+    position = start
+    while position + 8 <= end:
+        box_size, box_type = struct.unpack(">I4s", _read(fd, 8, position))
+        header_length = 8
+        if box_size == 1:
+            box_size = struct.unpack(">Q", _read(fd, 8, position + 8))[0]
+            header_length = 16
+        elif box_size == 0:
+            box_size = end - position
+        if box_size < header_length:
+            raise ProbeError(f"Invalid {box_type!r} box at {position}")
+        yield box_type, position + header_length, min(end, position + box_size)
+        position += box_size
+
+
+def _mp4_find(fd: int, start: int, end: int, path: tuple[bytes, ...]) -> Iterator[tuple[int, int]]:
+    for box_type, body_start, body_end in _mp4_boxes(fd, start, end):
+        if box_type == path[0]:
+            if len(path) == 1:
+                yield body_start, body_end
+            elif box_type in _mp4_containers:
+                yield from _mp4_find(fd, body_start, body_end, path[1:])
+
+
+def _mp4_language(packed: int) -> str:
+    # ISO 639-2/T, three 5-bit letters offset by 0x60
+    return "".join(chr(((packed >> shift) & 0x1F) + 0x60) for shift in (10, 5, 0))
+
+
+def _mp4_track(fd: int, start: int, end: int) -> dict[str, Any] | None:
+    kind = None
+    language = None
+    for body_start, body_end in _mp4_find(fd, start, end, (b"mdia", b"hdlr")):
+        kind = _mp4_handlers.get(_read(fd, 12, body_start)[8:12])
+    if kind is None:
+        return None
+    for body_start, body_end in _mp4_find(fd, start, end, (b"mdia", b"mdhd")):
+        body = _read(fd, min(body_end - body_start, 64), body_start)
+        offset = 32 if body[0] == 1 else 20
+        language = _mp4_language(struct.unpack(">H", body[offset : offset + 2])[0])
+
+    track = {"type": kind, "codec": None, "language": language, "default": True, "forced": False}
+    for body_start, body_end in _mp4_find(fd, start, end, (b"mdia", b"minf", b"stbl", b"stsd")):
+        # the first sample description is enough
+        entry = _read(fd, min(body_end - body_start, 64), body_start)[8:]
+        if len(entry) < 36:
+            break
+        codec = entry[4:8]
+        track["codec"] = _mp4_codecs.get(codec, codec.decode("latin-1").strip().lower())
+        if kind == "video":
+            track["width"], track["height"] = struct.unpack(">HH", entry[32:36])
+        elif kind == "audio":
+            track["channels"] = struct.unpack(">H", entry[24:26])[0]
+            track["samplingrate"] = struct.unpack(">I", entry[32:36])[0] >> 16
+    return track
+
+
+def _probe_mp4(fd: int, size: int) -> dict[str, Any]:
+    # moov is often after the media data, top level boxes are skipped by their sizes to reach it
+    moov = next(_mp4_find(fd, 0, size, (b"moov",)), None)
+    if moov is None:
+        raise ProbeError("No moov box")
+    duration = None
+    for body_start, body_end in _mp4_find(fd, *moov, (b"mvhd",)):
+        body = _read(fd, min(body_end - body_start, 32), body_start)
+        if body[0] == 1:
+            timescale, length = struct.unpack(">IQ", body[20:32])
+        else:
+            timescale, length = struct.unpack(">II", body[12:20])
+        duration = length / timescale if timescale else None
+    tracks = [_mp4_track(fd, *trak) for trak in _mp4_find(fd, *moov, (b"trak",))]
+    return {"container": "mp4", "duration": duration, "tracks": [track for track in tracks if track is not None]}
+
+
+def probe(file: Path | str) -> dict[str, Any] | None:
+    # container, duration in seconds and tracks, from the headers only, None for other containers
+    fd = os.open(file, os.O_RDONLY)
+    try:
+        size = os.fstat(fd).st_size
+        magic = os.pread(fd, 12, 0)
+        try:
+            if magic[:4] == _EBML.to_bytes(4, "big"):
+                return _probe_matroska(fd, size)
+            if magic[4:8] in (b"ftyp", b"moov", b"free", b"mdat", b"wide"):
+                return _probe_mp4(fd, size)
+        except (IndexError, TypeError, ValueError, struct.error) as exc:
+            # sizes and offsets read from a corrupt file
+            raise ProbeError(f"Invalid headers in {file}") from exc
+        return None
+    finally:
+        os.close(fd)
@@ -0,0 +1,53 @@
+import json
+import os
+import threading
+import time
+from pathlib import Path
+from typing import Any
+
+
+class ReviewQueue:
+    # files the unattended mode did not dare to process, one JSON object per line
+    def __init__(self, path: Path) -> None:
+        self._path = path
+        self._lock = threading.Lock()
+        # path -> latest entry without its time, read from the file on the first append
+        self._queued: dict[str, dict[str, Any]] | None = None
+
+    @property
+    def path(self) -> Path:
+        return self._path
+
+    def append(self, file: Path, reason: str, **details: Any) -> None:
+        entry = {"path": os.path.abspath(file), "reason": reason, "queued": time.time(), **details}
+        line = json.dumps(entry, default=str)
+        # what is compared, as read back from the file
+        queued = json.loads(json.dumps({**entry, "queued": None}, default=str))
+        with self._lock:
+            if self._queued is None:
+                self._queued = {path: {**previous, "queued": None} for path, previous in self._read().items()}
+            # files are offered again on every run, the queue only grows when something changed
+            if self._queued.get(entry["path"]) == queued:
+                return
+            self._queued[entry["path"]] = queued
+            self._path.parent.mkdir(exist_ok=True, parents=True)
+            with open(self._path, "a", encoding="utf-8") as queue_file:
+                queue_file.write(line + "\n")
+
+    def _read(self) -> dict[str, dict[str, Any]]:
+        if not self._path.exists():
+            return {}
+        entries = {}
+        with open(self._path, encoding="utf-8") as queue_file:
+            for line in queue_file:
+                if line.strip():
+                    entry = json.loads(line)
+                    # the latest entry for a file wins
+                    entries[entry["path"]] = entry
+        return entries
+
+    def load(self) -> list[dict[str, Any]]:
+        return [entry for entry in self._read().values() if os.path.exists(entry["path"])]
+
+    def pending(self) -> list[Path]:
+        return [Path(entry["path"]) for entry in self.load()]
@@ -0,0 +1,48 @@
+import fnmatch
+import logging
+import os
+import re
+
+# the walk shared by the first scan of a run and apollo watch, so both skip and pick up the same files
+
+
+def exclude_pattern(excludes: tuple[str, ...]) -> re.Pattern | None:
+    return re.compile("|".join(fnmatch.translate(glob) for glob in excludes)) if excludes else None
+
+
+def is_excluded(excluded: re.Pattern | None, path: str, root: str) -> bool:
+    # globs match the name, or the path relative to the scanned folder
+    if excluded is None:
+        return False
+    return bool(excluded.match(os.path.basename(path)) or excluded.match(os.path.relpath(path, root)))
+
+
+def is_media(path: str, extensions: frozenset[str]) -> bool:
+    return os.path.splitext(path)[1].lower() in extensions
+
+
+def list_directory(
+    directory: str,
+    root: str,
+    extensions: frozenset[str],
+    excluded: re.Pattern | None,
+    logger: logging.Logger,
+) -> tuple[list[os.DirEntry], list[str]]:
+    # media files and folders directly in directory, without the excluded ones
+    files = []
+    subdirs = []
+    try:
+        with os.scandir(directory) as entries:
+            for entry in entries:
+                if is_excluded(excluded, entry.path, root):
+                    logger.debug("Excluding %s", entry.path)
+                    continue
+                if entry.is_dir(follow_symlinks=False):
+                    subdirs.append(entry.path)
+                elif entry.is_file() and is_media(entry.name, extensions):
+                    files.append(entry)
+                else:
+                    logger.debug("Ignoring %s", entry.path)
+    except OSError as exc:
+        logger.warning("Unable to scan %s: %s", directory, exc)
+    return files, subdirs
@@ -0,0 +1,89 @@
+import difflib
+import functools
+import math
+import re
+import unicodedata
+
+_punctuation = re.compile(r"[^\w\s]")
+_spaces = re.compile(r"\s+")
+
+TITLE_WEIGHT = 0.7
+YEAR_WEIGHT = 0.2
+POPULARITY_WEIGHT = 0.1
+# same original language as the release, on top of the other scores
+LANGUAGE_BONUS = 0.05
+
+
+@functools.lru_cache(maxsize=4096)
+def normalize_title(title: str) -> str:
+    title = unicodedata.normalize("NFKD", title)
+    title = "".join(char for char in title if not unicodedata.combining(char))
+    title = _punctuation.sub(" ", title.casefold().replace("&", " and "))
+    return _spaces.sub(" ", title).strip()
+
+
+def title_similarity(first: str, second: str) -> float:
+    first, second = normalize_title(first), normalize_title(second)
+    if first == second:
+        return 1.0
+    return difflib.SequenceMatcher(None, first, second).ratio()
+
+
+def result_titles(result: dict) -> list[str]:
+    keys = ("title", "original_title", "name", "original_name")
+    return [result[key] for key in keys if result.get(key)]
+
+
+def release_year(result: dict) -> int | None:
+    date = result.get("release_date") or result.get("first_air_date")
+    return int(date[:4]) if date else None
+
+
+def year_agreement(year: int, result: dict) -> float:
+    found = release_year(result)
+    if found is None:
+        return 0.5
+    return {0: 1.0, 1: 0.5}.get(abs(int(year) - found), 0.0)
+
+
+def popularity(result: dict) -> float:
+    # TMDB popularity is unbounded, a few hundred is already very popular
+    return min(1.0, math.log10(1 + result.get("popularity", 0)) / 3)
+
+
+def score(title: str, year: int | None, result: dict, alternative_titles: list[str] | tuple[str, ...] = ()) -> float:
+    similarity = max(
+        (title_similarity(title, candidate) for candidate in (*result_titles(result), *alternative_titles)),
+        default=0.0,
+    )
+    total = TITLE_WEIGHT * similarity + POPULARITY_WEIGHT * popularity(result)
+    if year is None:
+        # nothing to compare, judge on the rest
+        return total / (TITLE_WEIGHT + POPULARITY_WEIGHT)
+    return total + YEAR_WEIGHT * year_agreement(year, result)
+
+
+def score_guess(guess: dict, result: dict) -> float:
+    title = guess.get("alternative_title") or guess.get("title", "")
+    if guess.get("part"):
+        title += " " + str(guess["part"])
+    # the year in an episode name is the show's, when there is one
+    return score(title, guess.get("year"), result)
+
+
+def rank(
+    title: str,
+    year: int | None,
+    results: list[dict],
+    language: str | None = None,
+    alternative_titles: dict[int, list[str]] | None = None,
+) -> list[dict]:
+    ranked = []
+    for result in results:
+        value = score(title, year, result, (alternative_titles or {}).get(result["id"], ()))
+        if language and result.get("original_language") == language:
+            value += LANGUAGE_BONUS
+        ranked.append(dict(result, score=round(value, 4)))
+    # sort is stable, TMDB's own order breaks ties
+    ranked.sort(key=lambda result: result["score"], reverse=True)
+    return ranked
@@ -1,54 +1,303 @@
+import collections
+import email.utils
 import enum
-from functools import cache
+import threading
+import time
+from concurrent.futures import Future
+from typing import Any, Callable
 
 import requests
+import requests.adapters
+
+from apollo import scoring
+from apollo.metrics import default_metrics
+from apollo.cache import Cache
+from apollo.offline import OfflineIndex
 
 
 class MovieNotFound(Exception):
     pass
 
 
+class RateLimiter:
+    # token bucket, shared by every thread using the client
+    def __init__(self, rate: float, burst: int | None = None) -> None:
+        self._rate = rate
+        self._capacity = burst or max(1, int(rate))
+        self._tokens = float(self._capacity)
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self) -> None:
+        with self._lock:
+            while True:
+                now = time.monotonic()
+                self._tokens = min(self._capacity, self._tokens + (now - self._updated) * self._rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                time.sleep((1 - self._tokens) / self._rate)
+
+
+class SingleFlight:
+    # concurrent calls with the same key share the first caller's result
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._calls: dict[str, Future] = {}
+
+    def do(self, key: str, func: Callable[[], Any]) -> tuple[Any, bool]:
+        with self._lock:
+            future = self._calls.get(key)
+            shared = future is not None
+            if not shared:
+                future = self._calls[key] = Future()
+        if shared:
+            return future.result(), True
+
+        try:
+            result = func()
+        except Exception as exc:
+            future.set_exception(exc)
+            raise
+        else:
+            future.set_result(result)
+        finally:
+            with self._lock:
+                del self._calls[key]
+        return result, False
+
+
 class TMDB:
     _url = "https://api.themoviedb.org/3/"
+    _retry_statuses = {429, 500, 502, 503, 504}
+    # below this score, alternative titles of the first few candidates are fetched to rank them again
+    _alternative_titles_below = 0.8
+    _alternative_titles_candidates = 3
+    # local titles this close to the query are looked up by id, skipping the search endpoint
+    _offline_min_similarity = 0.9
+    _offline_min_score = 0.85
 
     class VideoType(enum.Enum):
         ANY = 0
         MOVIE = 1
         SHOW = 2
 
-    def __init__(self, account_id: str, token: str) -> None:
+    def __init__(
+        self,
+        account_id: str,
+        token: str,
+        cache: Cache | None = None,
+        url: str | None = None,
+        pool_size: int = 20,
+        timeout: float = 10,
+        rate_limit: float = 40,
+        max_retries: int = 5,
+        backoff: float = 0.5,
+        offline_index: OfflineIndex | None = None,
+    ) -> None:
         self._account_id = account_id
         self._token = token
+        self._cache = cache
+        self._offline_index = offline_index
+        self._url = url or self._url
+        self._timeout = timeout
+        self._max_retries = max_retries
+        self._backoff = backoff
+        self._rate_limiter = RateLimiter(rate_limit)
+        self._single_flight = SingleFlight()
+        self._stats_lock = threading.Lock()
+        self._stats = collections.Counter(hits=0, misses=0, coalesced=0, offline=0)
+
+        self._session = requests.Session()
+        self._session.headers.update(
+            {
+                "accept": "application/json",
+                "Authorization": f"Bearer {self._token}",
+            }
+        )
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self._session.mount("https://", adapter)
+        self._session.mount("http://", adapter)
+
+    def close(self) -> None:
+        self._session.close()
+        if self._offline_index is not None:
+            self._offline_index.close()
+
+    @property
+    def stats(self) -> dict[str, int]:
+        with self._stats_lock:
+            return dict(self._stats)
+
+    def _count(self, name: str) -> None:
+        with self._stats_lock:
+            self._stats[name] += 1
+        default_metrics.count(f"tmdb.{name}")
+
+    def _retry_delay(self, attempt: int, response: requests.Response | None = None) -> float:
+        retry_after = response.headers.get("Retry-After") if response is not None else None
+        if retry_after:
+            try:
+                return max(0.0, float(retry_after))
+            except ValueError:
+                try:
+                    return max(0.0, email.utils.parsedate_to_datetime(retry_after).timestamp() - time.time())
+                except (TypeError, ValueError):
+                    pass
+        return self._backoff * 2**attempt
+
+    def _request(self, endpoint: str, params: dict[str, str] | None = None) -> requests.Response:
+        for attempt in range(self._max_retries + 1):
+            self._rate_limiter.acquire()
+            try:
+                with default_metrics.timer("tmdb.request"):
+                    _r = self._session.get(self._url + endpoint, params=params, timeout=self._timeout)
+            except (requests.ConnectionError, requests.Timeout):
+                if attempt == self._max_retries:
+                    raise
+                default_metrics.count("tmdb.retries")
+                time.sleep(self._retry_delay(attempt))
+                continue
+            if _r.status_code not in self._retry_statuses:
+                return _r
+            default_metrics.count("tmdb.retries")
+            if attempt < self._max_retries:
+                time.sleep(self._retry_delay(attempt, _r))
+        _r.raise_for_status()
+        return _r
 
     def _get(self, endpoint: str, params: dict[str, str] | None = None):
-        _headers = {
-            "accept": "application/json",
-            "Authorization": f"Bearer {self._token}",
-        }
-
-        _r = requests.get(url=self._url + endpoint, headers=_headers, params=params)
-        return _r.json()
-    
-    @cache
-    def search(
+        cache_key = Cache.make_key(endpoint, params)
+        data, shared = self._single_flight.do(cache_key, lambda: self._fetch(cache_key, endpoint, params))
+        if shared:
+            self._count("coalesced")
+        return data
+
+    def _fetch(self, cache_key: str, endpoint: str, params: dict[str, str] | None = None):
+        if self._cache is not None:
+            data = self._cache.get(cache_key)
+            if data is not None:
+                self._count("hits")
+                return data
+
+        self._count("misses")
+        _r = self._request(endpoint, params)
+        data = _r.json()
+
+        if self._cache is not None and (_r.ok or _r.status_code == 404):
+            # empty searches and unknown ids are kept too, but for a shorter time
+            negative = _r.status_code == 404 or ("results" in data and not data["results"])
+            self._cache.set(cache_key, data, negative=negative)
+        return data
+
+    def alternative_titles(self, video_type: str, tmdb_id: int) -> list[str]:
+        data = self._get(f"{video_type}/{tmdb_id}/alternative_titles")
+        # movies list them under "titles", shows under "results"
+        return [title["title"] for title in data.get("titles", data.get("results", [])) if title.get("title")]
+
+    def search_candidates(
         self,
         query: str,
         video_type: str,
         year: str | None = None,
-    ):
+        language: str | None = None,
+    ) -> list[dict]:
         params = {"query": query}
         if year is not None:
             params["year"] = year
         if video_type == "movie":
-            results = self._get("search/movie", params=params).get("results")
+            endpoint = "search/movie"
         elif video_type == "tv":
-            results = self._get("search/tv", params=params).get("results")
-        else: 
+            endpoint = "search/tv"
+        else:
             raise NotImplementedError(video_type)
-        if not results:
+
+        ranked_key = Cache.make_key(f"ranked/{endpoint}", {**params, "language": language or ""})
+        if self._cache is not None:
+            ranked = self._cache.get(ranked_key)
+            if ranked is not None:
+                return ranked
+
+        results = self._get(endpoint, params=params).get("results") or []
+        ranked = scoring.rank(query, year, results, language)
+        if ranked and ranked[0]["score"] < self._alternative_titles_below:
+            # no convincing title match, the right one may be known under another title
+            alternative_titles = {
+                result["id"]: self.alternative_titles(video_type, result["id"])
+                for result in ranked[: self._alternative_titles_candidates]
+            }
+            ranked = scoring.rank(query, year, results, language, alternative_titles)
+
+        if self._cache is not None:
+            self._cache.set(ranked_key, ranked, negative=not ranked)
+        return ranked
+
+    def _search_offline(
+        self,
+        query: str,
+        video_type: str,
+        year: str | None = None,
+        language: str | None = None,
+    ) -> dict | None:
+        matches = [
+            match
+            for match in self._offline_index.search(query, video_type)
+            if max(scoring.title_similarity(query, title) for title in scoring.result_titles(match))
+            >= self._offline_min_similarity
+        ]
+        if not matches:
+            return None
+        # the export only has original titles and popularity, years and languages come with the details
+        # so the best local match is the only one looked up, then scored again with them
+        best = scoring.rank(query, None, matches)[0]
+        details = (self.get_movie if video_type == "movie" else self.get_show)(best["id"])
+        ranked = scoring.rank(query, year, [details] if "id" in details else [], language)
+        if not ranked or ranked[0]["score"] < self._offline_min_score:
+            return None
+        return ranked[0]
+
+    def search(
+        self,
+        query: str,
+        video_type: str,
+        year: str | None = None,
+        language: str | None = None,
+    ):
+        if self._offline_index is not None:
+            result = self._search_offline(query, video_type, year, language)
+            if result is not None:
+                self._count("offline")
+                return result
+        candidates = self.search_candidates(query, video_type, year, language)
+        if not candidates:
             raise MovieNotFound(f"Unable to find movie matching: {query}")
-        return results[0]
-    
-    @cache
-    def search_episode(self, series_id: int, season_number: int, episode_number: int):
-        return self._get(f"tv/{series_id}/season/{season_number}/episode/{episode_number}")
+        return candidates[0]
+
+    def get_movie(self, movie_id: int):
+        return self._get(f"movie/{movie_id}")
+
+    def get_show(self, series_id: int, seasons: list[int] | tuple[int, ...] = ()):
+        # TMDB allows up to 20 appended responses per call
+        params = {"append_to_response": ",".join(f"season/{season}" for season in seasons[:20])} if seasons else None
+        show = self._get(f"tv/{series_id}", params=params)
+        if self._cache is not None:
+            for season in seasons[:20]:
+                if f"season/{season}" in show:
+                    self._cache.set(Cache.make_key(f"tv/{series_id}/season/{season}"), show[f"season/{season}"])
+        return show
+
+    def get_season(self, series_id: int, season_number: int):
+        return self._get(f"tv/{series_id}/season/{season_number}")
+
+    def search_episode(self, series_id: int, season_number: int, episode_number: int, season: dict | None = None):
+        # one request per season instead of one per episode, none when it came appended to the show
+        season = season or self.get_season(series_id, season_number)
+        for episode in season.get("episodes", []):
+            if episode["episode_number"] == episode_number:
+                return episode
+        episode = self._get(f"tv/{series_id}/season/{season_number}/episode/{episode_number}")
+        # unknown seasons and episodes come back as an error body
+        if "id" not in episode:
+            raise MovieNotFound(f"Unable to find episode S{season_number:02}E{episode_number:02} of show {series_id}")
+        return episode
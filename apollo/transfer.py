@@ -0,0 +1,272 @@
+import errno
+import os
+import shutil
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from pathlib import Path
+from typing import Callable, NamedTuple
+
+from apollo.metrics import default_metrics
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+# linux/fs.h, clone a whole file on btrfs/XFS/bcachefs
+FICLONE = 0x40049409
+
+CHUNK_SIZE = 8 * 1024 * 1024
+
+# errors meaning "this method is not available here", anything else is a real failure
+_unsupported = {errno.EXDEV, errno.EINVAL, errno.ENOSYS, errno.EOPNOTSUPP, errno.ENOTTY}
+
+
+class TransferProgress(NamedTuple):
+    source: Path
+    destination: Path
+    copied: int
+    size: int
+    rate: float
+    done: bool = False
+
+
+class TransferResult(NamedTuple):
+    method: str
+    size: int
+    seconds: float
+
+    @property
+    def rate(self) -> float:
+        # bytes per second
+        return self.size / self.seconds if self.seconds > 0 else float("inf")
+
+
+def _short_copy(copied: int, size: int) -> OSError:
+    # the source changed size while being copied, the copy must not replace it
+    return OSError(errno.EIO, f"Copied {copied} of {size} bytes")
+
+
+def _reflink(source_fd: int, destination_fd: int, size: int, progress: Callable[[int], None]) -> bool:
+    if fcntl is None:
+        return False
+    try:
+        fcntl.ioctl(destination_fd, FICLONE, source_fd)
+    except OSError as exc:
+        if exc.errno in _unsupported:
+            return False
+        raise
+    progress(size)
+    return True
+
+
+def _copy_file_range(source_fd: int, destination_fd: int, size: int, progress: Callable[[int], None]) -> bool:
+    if not hasattr(os, "copy_file_range"):
+        return False
+    copied = 0
+    while copied < size:
+        try:
+            sent = os.copy_file_range(source_fd, destination_fd, min(CHUNK_SIZE, size - copied))
+        except OSError as exc:
+            # only fall back when nothing was written yet
+            if copied == 0 and exc.errno in _unsupported:
+                return False
+            raise
+        if sent == 0:
+            if copied == 0:
+                # nothing copied, some filesystems just do not support it
+                return False
+            raise _short_copy(copied, size)
+        copied += sent
+        progress(copied)
+    return True
+
+
+def _sendfile(source_fd: int, destination_fd: int, size: int, progress: Callable[[int], None]) -> bool:
+    if not hasattr(os, "sendfile"):
+        return False
+    copied = 0
+    while copied < size:
+        try:
+            sent = os.sendfile(destination_fd, source_fd, copied, min(CHUNK_SIZE, size - copied))
+        except OSError as exc:
+            if copied == 0 and exc.errno in _unsupported:
+                return False
+            raise
+        if sent == 0:
+            if copied == 0:
+                # nothing copied, some filesystems just do not support it
+                return False
+            raise _short_copy(copied, size)
+        copied += sent
+        progress(copied)
+    return True
+
+
+def _chunked(source_fd: int, destination_fd: int, size: int, progress: Callable[[int], None]) -> bool:
+    buffer = bytearray(CHUNK_SIZE)
+    view = memoryview(buffer)
+    copied = 0
+    while (read := os.readv(source_fd, [buffer])) > 0:
+        written = 0
+        while written < read:
+            written += os.write(destination_fd, view[written:read])
+        copied += read
+        progress(copied)
+    if copied != size:
+        raise _short_copy(copied, size)
+    return True
+
+
+_methods = (
+    ("reflink", _reflink),
+    ("copy_file_range", _copy_file_range),
+    ("sendfile", _sendfile),
+    ("chunked", _chunked),
+)
+
+
+def _fsync_dir(directory: Path) -> None:
+    fd = os.open(directory, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def _ignore_progress(copied: int) -> None:
+    pass
+
+
+def copy_file(
+    source: Path,
+    destination: Path,
+    fsync: bool = False,
+    progress: Callable[[int], None] = _ignore_progress,
+    created: Callable[[], None] | None = None,
+) -> str:
+    size = os.stat(source).st_size
+    # never replaces an existing file, and only removes the one it created on failure
+    with open(source, "rb") as source_file, open(destination, "xb") as destination_file:
+        if created is not None:
+            created()
+        try:
+            for method, copy in _methods:
+                if copy(source_file.fileno(), destination_file.fileno(), size, progress):
+                    break
+            if fsync:
+                os.fsync(destination_file.fileno())
+        except BaseException:
+            destination_file.close()
+            os.unlink(destination)
+            raise
+    shutil.copystat(source, destination)
+    return method
+
+
+def transfer(
+    source: Path,
+    destination: Path,
+    move: bool = True,
+    fsync: bool = False,
+    progress: Callable[[int], None] = _ignore_progress,
+    created: Callable[[], None] | None = None,
+) -> TransferResult:
+    start = time.perf_counter()
+    size = os.stat(source).st_size
+
+    method = None
+    if move:
+        if os.path.lexists(destination):
+            raise FileExistsError(errno.EEXIST, "File exists", os.fspath(destination))
+        try:
+            os.rename(source, destination)
+            method = "rename"
+            progress(size)
+        except OSError as exc:
+            if exc.errno != errno.EXDEV:
+                raise
+    if method is None:
+        method = copy_file(source, destination, fsync, progress, created)
+        if move:
+            os.unlink(source)
+    if fsync:
+        _fsync_dir(Path(destination).parent)
+
+    return TransferResult(method, size, time.perf_counter() - start)
+
+
+def _device(path: Path) -> int:
+    # the destination usually does not exist yet, use its closest existing parent
+    for candidate in (path, *path.parents):
+        try:
+            return os.stat(candidate).st_dev
+        except FileNotFoundError:
+            continue
+    raise FileNotFoundError(path)
+
+
+class TransferQueue:
+    # background transfers, at most per_device running against the same source or destination device
+    def __init__(
+        self,
+        workers: int = 4,
+        per_device: int = 1,
+        fsync: bool = False,
+        on_progress: Callable[[TransferProgress], None] | None = None,
+    ) -> None:
+        self._pool = ThreadPoolExecutor(workers, thread_name_prefix="transfer")
+        self._per_device = per_device
+        self._fsync = fsync
+        self._on_progress = on_progress
+        self._lock = threading.Lock()
+        self._devices: dict[int, threading.Semaphore] = {}
+
+    def _semaphore(self, device: int) -> threading.Semaphore:
+        with self._lock:
+            if device not in self._devices:
+                self._devices[device] = threading.Semaphore(self._per_device)
+            return self._devices[device]
+
+    def _run(
+        self, source: Path, destination: Path, move: bool, created: Callable[[], None] | None
+    ) -> TransferResult:
+        destination.parent.mkdir(exist_ok=True, parents=True)
+        size = os.stat(source).st_size
+        start = time.perf_counter()
+
+        def _progress(copied: int) -> None:
+            if self._on_progress is not None:
+                elapsed = time.perf_counter() - start
+                self._on_progress(
+                    TransferProgress(source, destination, copied, size, copied / elapsed if elapsed > 0 else 0.0)
+                )
+
+        # always take device locks in the same order so two opposite transfers cannot deadlock
+        semaphores = [self._semaphore(device) for device in sorted({_device(source), _device(destination)})]
+        with default_metrics.timer("transfer.wait"):
+            for semaphore in semaphores:
+                semaphore.acquire()
+        try:
+            result = transfer(
+                source, destination, move=move, fsync=self._fsync, progress=_progress, created=created
+            )
+        finally:
+            for semaphore in reversed(semaphores):
+                semaphore.release()
+
+        default_metrics.observe(f"transfer.{result.method}", result.seconds)
+        default_metrics.count("transfer.bytes", result.size)
+        if self._on_progress is not None:
+            self._on_progress(TransferProgress(source, destination, result.size, result.size, result.rate, True))
+        return result
+
+    def submit(
+        self, source: Path, destination: Path, move: bool = True, created: Callable[[], None] | None = None
+    ) -> Future:
+        # created is called once the destination file exists when it is copied
+        return self._pool.submit(self._run, source, destination, move, created)
+
+    def shutdown(self, wait: bool = True) -> None:
+        self._pool.shutdown(wait=wait)
@@ -1,17 +1,71 @@
+import os
+import time
 from pathlib import Path
-import shutil
 
+import rich.segment
+import textual
 import textual.app
 import textual.containers
-import textual.lazy
+import textual.events
+import textual.geometry
+import textual.message
+import textual.reactive
 import textual.screen
+import textual.scroll_view
+import textual.strip
 import textual.widgets
+import textual.worker
 
-from apollo import common, tmdb
+from apollo import common, library, naming, prefetch, tmdb, transfer
 
 logger = common.setup_logger(__name__)
 
 
+class TransferUpdated(textual.message.Message):
+    def __init__(self, progress: transfer.TransferProgress) -> None:
+        self.progress = progress
+        super().__init__()
+
+
+class MediasFound(textual.message.Message):
+    def __init__(self, medias: list[Path], done: bool = False) -> None:
+        self.medias = medias
+        self.done = done
+        super().__init__()
+
+
+class TransferFailed(textual.message.Message):
+    def __init__(self, source: Path, error: Exception) -> None:
+        self.source = source
+        self.error = error
+        super().__init__()
+
+
+def resolve_media(
+    tmdb_client: tmdb.TMDB,
+    output_folder: Path,
+    media: Path,
+    forced_type: str | None = None,
+    forced_title: str | None = None,
+    guess: dict | None = None,
+) -> tuple[str, dict | None, dict | None, Path | None, Exception | None]:
+    try:
+        media_type, media_infos, extra_infos = common.get_media_info(
+            tmdb_client,
+            media,
+            forced_type=forced_type,
+            forced_title=forced_title,
+            logger=logger,
+            guess=guess,
+        )
+        streams = common.probe_file(media, None, logger) if naming.default_naming.needs_streams(media_type) else None
+        destination = common.generate_new_path(output_folder, media, media_type, media_infos, extra_infos, streams)
+    except Exception as exc:
+        # network errors or an unexpected guess should not take the whole app down
+        return "movie", None, None, None, exc
+    return media_type, media_infos, extra_infos, destination, None
+
+
 class AppProcessMovieScreenContainer(textual.containers.Container):
 
     def __init__(self, media_infos: dict | None, movie_not_found: bool = False, *args, **kwargs):
@@ -21,8 +75,7 @@ class AppProcessMovieScreenContainer(textual.containers.Container):
 
     def on_input_submitted(self, submitted: textual.widgets.Input.Submitted):
         if submitted.input.id == "movie-title":
-            self.parent.update_media_data(forced_title=submitted.input.value)
-            self.parent.refresh(recompose=True)
+            self.screen.update_media_data(forced_title=submitted.input.value)
 
     def compose(self) -> textual.app.ComposeResult:
         with textual.containers.Horizontal():
@@ -48,6 +101,11 @@ class AppProcessEpisodeScreenContainer(textual.containers.Container):
         raise NotImplementedError()
 
 
+class AppProcessMediaDetails(textual.containers.Container):
+    def compose(self) -> textual.app.ComposeResult:
+        yield from self.screen.compose_details()
+
+
 class AppProcessMediaScreen(textual.screen.ModalScreen):
     BINDINGS = [
         ("q", "stop", "Stop Processing Media"),
@@ -56,32 +114,40 @@ class AppProcessMediaScreen(textual.screen.ModalScreen):
         ("ctrl+d", "delete", "Delete"),
     ]
 
-    def __init__(self, media: Path, origin_widget, *args, **kwargs):
+    def __init__(self, media: Path, *args, **kwargs):
         self._media = media
-        self._origin_widget = origin_widget
         self._forced_title = None
         self._forced_type = None
-        self.update_media_data()
+        self._set_loading()
 
         super().__init__(*args, **kwargs)
 
-    def _remove_origin_widget(self):
-        self._origin_widget.remove()
-        self.dismiss()
-        self.app.query_one("#content").focus()
+    def _set_loading(self, guess: dict | None = None) -> None:
+        self._loading = True
+        self._guess = guess
+        self._error_state = None
+        self._media_type = self._forced_type or (guess or {}).get("type")
+        self._media_infos = None
+        self._extra_infos = None
+        self._destination = None
+
+    def _remove_media(self):
+        self.dismiss(self._media)
 
     def action_stop(self):
         self.dismiss()
 
     def action_move(self):
-        self._destination.parent.mkdir(exist_ok=True, parents=True)
-        self._media.rename(self._destination)
-        self._remove_origin_widget()
+        if self._destination is None:
+            return
+        self.app.transfer(self._media, self._destination, move=True)
+        self._remove_media()
 
     def action_copy(self):
-        self._destination.parent.mkdir(exist_ok=True, parents=True)
-        shutil.copy(self._media, self._destination)
-        self._remove_origin_widget()
+        if self._destination is None:
+            return
+        self.app.transfer(self._media, self._destination, move=False)
+        self._remove_media()
 
     def action_delete(self):
         raise NotImplementedError()
@@ -96,116 +162,386 @@ class AppProcessMediaScreen(textual.screen.ModalScreen):
 
     def on_mount(self):
         self.title = self._media.name
+        self.lookup_media()
 
     def update_media_data(self, forced_type: str | None = None, forced_title: str | None = None) -> None:
-        self._error_state = None
         self._forced_title = forced_title or self._forced_title
         self._forced_type = forced_type or self._forced_type
-        try:
-            self._media_type, self._media_infos, self._extra_infos = common.get_media_info(
+        self._set_loading(self._guess)
+        self._refresh_details()
+        # exclusive: a lookup still running for a previous title is cancelled
+        self.lookup_media()
+
+    @textual.work(thread=True, exclusive=True, group="lookup")
+    def lookup_media(self) -> None:
+        worker = textual.worker.get_current_worker()
+        prefetched = None
+        if not (self._forced_type or self._forced_title):
+            prefetched = self.app.prefetched(self._media)
+
+        if prefetched is not None:
+            resolved = prefetched.result()
+        else:
+            guess = common.guess_media(self._media)
+            if worker.is_cancelled:
+                return
+            self.app.call_from_thread(self._guess_loaded, guess)
+            resolved = resolve_media(
                 self.app.tmdb_client,
+                self.app._output_folder,
                 self._media,
                 forced_type=self._forced_type,
                 forced_title=self._forced_title,
-                logger=logger,
-            )
-            self._destination = common.generate_new_path(
-                self.app._output_folder,
-                self._media,
-                self._media_type,
-                self._media_infos,
-                self._extra_infos,
+                guess=guess,
             )
-        except tmdb.MovieNotFound as exc:
-            self._media_type = "movie"
-            self._media_infos = None
-            self._error_state = exc
+        if worker.is_cancelled:
+            return
+        self.app.call_from_thread(self._media_data_loaded, *resolved)
+
+    def _guess_loaded(self, guess: dict) -> None:
+        self._set_loading(guess)
+        self._refresh_details()
+
+    def _media_data_loaded(
+        self,
+        media_type: str,
+        media_infos: dict | None,
+        extra_infos: dict | None,
+        destination: Path | None,
+        error_state: Exception | None,
+    ) -> None:
+        self._loading = False
+        self._media_type = media_type
+        self._media_infos = media_infos
+        self._extra_infos = extra_infos
+        self._destination = destination
+        self._error_state = error_state
+        if error_state is not None and not isinstance(error_state, tmdb.MovieNotFound):
+            logger.error("Unable to look up %s", self._media, exc_info=error_state)
+        self._refresh_details()
 
-    def compose(self):
+    def _refresh_details(self) -> None:
+        # recomposing the whole screen would also replace the header while it updates its title
+        self.query_one(AppProcessMediaDetails).refresh(recompose=True)
 
+    def compose(self):
         yield textual.widgets.Header()
+        yield AppProcessMediaDetails()
+        yield textual.widgets.Footer()
+
+    def compose_details(self):
         with textual.containers.Container():
             with textual.widgets.RadioSet():
                 # TODO: handle change of radio button
                 yield textual.widgets.RadioButton("movie", value=self._media_type == "movie")
                 yield textual.widgets.RadioButton("episode", value=self._media_type == "episode")
-        if self._media_type == "movie":
+        if self._loading:
+            if self._guess is not None:
+                yield textual.widgets.Static(
+                    f"Looking up {self._forced_title or self._guess.get('title', self._media.name)}...",
+                    classes="loading-message",
+                    markup=False,
+                )
+            yield textual.widgets.LoadingIndicator()
+        elif self._error_state is not None and not isinstance(self._error_state, tmdb.MovieNotFound):
+            with textual.containers.Center():
+                yield textual.widgets.Static(str(self._error_state), classes="error-message", markup=False)
+        elif self._media_type == "movie":
             yield AppProcessMovieScreenContainer(
                 self._media_infos, movie_not_found=isinstance(self._error_state, tmdb.MovieNotFound)
             )
         elif self._media_type == "episode":
             yield AppProcessEpisodeScreenContainer(self._media_infos, self._extra_infos)
-        if self._error_state is None:
+        if self._destination is not None:
             with textual.containers.Horizontal(classes="destination-container"):
                 yield textual.widgets.Label("Destination : ")
                 yield textual.widgets.Static(self._destination.as_posix(), markup=False)
-                if self._destination.exists():
+                if self.app.library.exists(self._destination):
                     yield textual.widgets.Static("❗")
                 # TODO: show new path / add color if file already exists
+            # the same media under another name, another quality for instance
+            existing = [
+                path
+                for path in self.app.library.find(
+                    self._media_type,
+                    self._media_infos["id"],
+                    self._extra_infos.get("season_number"),
+                    self._extra_infos.get("episode_number"),
+                )
+                if path != Path(os.path.abspath(self._destination))
+            ]
+            if existing:
+                yield textual.widgets.Static(
+                    f"Already in the library: {', '.join(path.name for path in existing)}",
+                    classes="library-message",
+                    markup=False,
+                )
         with textual.containers.Horizontal(classes="destination-buttons"):
-            if self._error_state is None:
+            if self._destination is not None:
                 yield textual.widgets.Button("Move", id="move")
                 yield textual.widgets.Button("Copy", id="copy")
             yield textual.widgets.Button("Delete", id="delete")
-        yield textual.widgets.Footer()
 
 
-class AppMediaContainer(textual.containers.Container):
-    def __init__(self, media: Path, *args, **kwargs):
-        self._media = media
+class AppContentContainer(textual.scroll_view.ScrollView, can_focus=True):
+    # only the visible rows are rendered, and adding rows does not measure anything,
+    # so this stays fast with a lot of media
+    BINDINGS = [
+        ("up", "cursor_up", "Up"),
+        ("down", "cursor_down", "Down"),
+        ("pageup", "page_up", "Page Up"),
+        ("pagedown", "page_down", "Page Down"),
+        ("home", "first", "First"),
+        ("end", "last", "Last"),
+        ("enter", "select", "Process Media"),
+    ]
+    COMPONENT_CLASSES = {"media-list--cursor"}
+
+    cursor = textual.reactive.reactive(0)
+
+    class Selected(textual.message.Message):
+        def __init__(self, media: Path) -> None:
+            self.media = media
+            super().__init__()
+
+    class Highlighted(textual.message.Message):
+        pass
+
+    def __init__(self, *args, **kwargs):
+        self._medias: list[Path] = []
         super().__init__(*args, **kwargs)
 
-    def on_button_pressed(self, event: textual.widgets.Button.Pressed):
-        if event.button.id == "process":
-            self.app.push_screen(AppProcessMediaScreen(self._media, origin_widget=self))
+    @property
+    def media_count(self) -> int:
+        return len(self._medias)
 
-    def compose(self) -> textual.app.ComposeResult:
-        yield textual.widgets.Label("File: ")
-        yield textual.widgets.Static(self._media.name, classes="media-title")
-        yield textual.widgets.Button("Process", id="process", classes="media-button").focus()
+    def _update_size(self) -> None:
+        self.virtual_size = textual.geometry.Size(self.size.width, len(self._medias))
+        self.cursor = min(self.cursor, max(len(self._medias) - 1, 0))
+        self.refresh()
+
+    def add_medias(self, medias: list[Path]) -> None:
+        self._medias.extend(medias)
+        self._update_size()
+
+    def remove_media(self, media: Path) -> None:
+        self._medias.remove(media)
+        self._update_size()
+
+    def selected_media(self) -> Path | None:
+        return self._medias[self.cursor] if self._medias else None
+
+    def upcoming_medias(self, count: int) -> list[Path]:
+        return self._medias[self.cursor : self.cursor + count]
+
+    def render_line(self, y: int) -> textual.strip.Strip:
+        scroll_x, scroll_y = self.scroll_offset
+        index = scroll_y + y
+        width = self.size.width
+        if index >= len(self._medias):
+            return textual.strip.Strip.blank(width, self.rich_style)
+        style = self.get_component_rich_style("media-list--cursor") if index == self.cursor else self.rich_style
+        strip = textual.strip.Strip([rich.segment.Segment(self._medias[index].as_posix(), style)])
+        return strip.crop_extend(scroll_x, scroll_x + width, style)
+
+    def watch_cursor(self, previous: int, cursor: int) -> None:
+        self.refresh()
+        self.scroll_to_region(textual.geometry.Region(0, cursor, 1, 1), animate=False)
+        self.post_message(self.Highlighted())
+
+    def action_cursor_up(self) -> None:
+        self.cursor = max(self.cursor - 1, 0)
+
+    def action_cursor_down(self) -> None:
+        self.cursor = min(self.cursor + 1, max(len(self._medias) - 1, 0))
+
+    def action_page_up(self) -> None:
+        self.cursor = max(self.cursor - self.size.height, 0)
 
+    def action_page_down(self) -> None:
+        self.cursor = min(self.cursor + self.size.height, max(len(self._medias) - 1, 0))
 
-class AppContentContainer(textual.containers.ScrollableContainer):
-    pass
-    # def compose(self) -> textual.app.ComposeResult:
-    #     pass
-    #     # TODO: find something better, this is too slow when input contains a lot of media
-    #     for media in common.iterate_inputs(self.app._input_folder, logger):
-    #         yield textual.lazy.Lazy(AppMediaContainer(media))
+    def action_first(self) -> None:
+        self.cursor = 0
+
+    def action_last(self) -> None:
+        self.cursor = max(len(self._medias) - 1, 0)
+
+    def action_select(self) -> None:
+        if self._medias:
+            self.post_message(self.Selected(self._medias[self.cursor]))
+
+    def on_click(self, event: textual.events.Click) -> None:
+        index = self.scroll_offset.y + event.y
+        if index < len(self._medias):
+            self.cursor = index
+            if event.chain > 1:
+                self.action_select()
+
+    def on_resize(self) -> None:
+        self._update_size()
 
 
 class App(textual.app.App):
     CSS_PATH = "statics/apollo.tcss"
     BINDINGS = [
         ("n", "next", "Next Media"),
+        ("p", "process", "Process Media"),
         ("q", "exit", "Exit"),
     ]
-
-    def __init__(self, input_folder: Path, output_folder: Path, tmdb_client: tmdb.TMDB, *args, **kwargs):
+    # scanned files are sent to the list in batches, at most this often
+    SCAN_BATCH_INTERVAL = 0.1
+
+    def __init__(
+        self,
+        input_folder: Path,
+        output_folder: Path,
+        tmdb_client: tmdb.TMDB,
+        scan_options: dict | None = None,
+        settings: dict | None = None,
+        medias: list[Path] | None = None,
+        library_index: library.LibraryIndex | None = None,
+        *args,
+        **kwargs,
+    ):
+        self._library = library_index or library.LibraryIndex()
+        self._transfer_queue = common.setup_transfer_queue(
+            settings or {}, on_progress=lambda progress: self.post_message(TransferUpdated(progress))
+        )
+        self._transfers: dict[Path, transfer.TransferProgress] = {}
+        tui_settings = (settings or {}).get("tui", {})
+        self._prefetch_count = tui_settings.get("prefetch", 10)
+        self._prefetcher = prefetch.Prefetcher(
+            lambda media: resolve_media(self._tmdb_client, self._output_folder, media),
+            workers=tui_settings.get("prefetch_workers", 2),
+            max_size=max(2 * self._prefetch_count, 1),
+        )
         self._input_folder = input_folder
         self._output_folder = output_folder
         self._tmdb_client = tmdb_client
-        self._medias = common.iterate_inputs(self.app._input_folder, logger)
+        self._scan_options = scan_options or {}
+        self._medias = medias
         super().__init__(*args, **kwargs)
 
     @property
     def tmdb_client(self):
         return self._tmdb_client
 
+    @property
+    def library(self) -> library.LibraryIndex:
+        return self._library
+
     def action_exit(self) -> None:
         return self.exit()
 
+    def transfer(self, source: Path, destination: Path, move: bool) -> None:
+        future = self._transfer_queue.submit(source, destination, move=move)
+        self._library.add(destination)
+
+        def _done(future):
+            if future.exception() is not None:
+                self._library.remove(destination)
+                self.post_message(TransferFailed(source, future.exception()))
+            elif move:
+                self._library.remove(source)
+
+        future.add_done_callback(_done)
+
+    def _render_transfers(self) -> None:
+        self.query_one("#transfers").update(
+            "\n".join(
+                f"{progress.source.name}: {progress.copied / max(progress.size, 1):.0%} "
+                f"({progress.rate / 2**20:.1f} MiB/s)"
+                for progress in self._transfers.values()
+            )
+        )
+
+    def on_transfer_updated(self, message: TransferUpdated) -> None:
+        progress = message.progress
+        if progress.done:
+            self._transfers.pop(progress.source, None)
+            self.notify(f"{progress.destination.name} done ({progress.rate / 2**20:.1f} MiB/s)")
+        else:
+            self._transfers[progress.source] = progress
+        self._render_transfers()
+
+    def on_transfer_failed(self, message: TransferFailed) -> None:
+        self._transfers.pop(message.source, None)
+        self.notify(f"Unable to transfer {message.source.name}: {message.error}", severity="error")
+        self._render_transfers()
+        # back in the list, it was removed when the transfer was started
+        if message.source.exists():
+            self.query_one("#content").add_medias([message.source])
+
+    def on_unmount(self) -> None:
+        self._prefetcher.shutdown()
+        # let running copies finish instead of leaving partial files behind
+        self._transfer_queue.shutdown()
+
     def action_next(self) -> None:
-        new_media = AppMediaContainer(next(self._medias))
-        self.query_one("#content").mount(new_media)
-        new_media.scroll_visible()
+        self.query_one("#content").action_cursor_down()
+
+    def action_process(self) -> None:
+        media = self.query_one("#content").selected_media()
+        if media is not None:
+            self.push_screen(AppProcessMediaScreen(media), self._media_processed)
+
+    def on_app_content_container_selected(self, message: AppContentContainer.Selected) -> None:
+        self.push_screen(AppProcessMediaScreen(message.media), self._media_processed)
+
+    def _media_processed(self, media: Path | None) -> None:
+        content = self.query_one("#content")
+        if media is not None:
+            content.remove_media(media)
+            self._prefetcher.discard(media)
+            self._prefetch()
+        content.focus()
+
+    def prefetched(self, media: Path):
+        return self._prefetcher.get(media)
+
+    def _prefetch(self) -> None:
+        if self._prefetch_count > 0:
+            self._prefetcher.prefetch(self.query_one("#content").upcoming_medias(self._prefetch_count))
+
+    def on_app_content_container_highlighted(self, message: AppContentContainer.Highlighted) -> None:
+        self._prefetch()
+
+    @textual.work(thread=True, exclusive=True, group="scan")
+    def scan_inputs(self) -> None:
+        if self._medias is not None:
+            # reviewing files queued by an unattended run instead of the whole input folder
+            self.post_message(MediasFound(self._medias, done=True))
+            return
+
+        worker = textual.worker.get_current_worker()
+        batch = []
+        last_sent = time.monotonic()
+        for media in common.iterate_inputs(self._input_folder, logger, **self._scan_options):
+            if worker.is_cancelled:
+                return
+            batch.append(media)
+            if time.monotonic() - last_sent >= self.SCAN_BATCH_INTERVAL:
+                self.post_message(MediasFound(batch))
+                batch = []
+                last_sent = time.monotonic()
+        self.post_message(MediasFound(batch, done=True))
+
+    def on_medias_found(self, message: MediasFound) -> None:
+        content = self.query_one("#content")
+        content.add_medias(message.medias)
+        self._prefetch()
+        self.sub_title = f"{content.media_count} files" + ("" if message.done else ", scanning...")
 
     def on_mount(self):
         self.title = "Apollo Media Manager"
+        self.query_one("#content").focus()
+        self.scan_inputs()
 
     def compose(self) -> textual.app.ComposeResult:
         yield textual.widgets.Header()
         yield AppContentContainer(id="content")
+        yield textual.widgets.Static(id="transfers", markup=False)
         yield textual.widgets.Footer()
 
 
@@ -214,9 +550,18 @@ def run():
     settings = common.load_settings(args, logger)
     common.set_log_level(args, logger)
     tmdb_client = common.setup_tmdb_client(settings)
+    common.setup_naming(settings)
+
+    medias = common.setup_review_queue(args, settings).pending() if args.review else None
+
+    library_index = common.setup_library(args.output, settings, logger)
 
-    app = App(args.input, args.output, tmdb_client)
-    app.run()
+    app = App(args.input, args.output, tmdb_client, common.scan_options(settings), settings, medias, library_index)
+    profiler = common.setup_profiler(args)
+    try:
+        app.run()
+    finally:
+        common.report_metrics(args, settings, logger, profiler)
 
 
 if __name__ == "__main__":
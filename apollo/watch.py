@@ -0,0 +1,188 @@
+import ctypes
+import ctypes.util
+import errno
+import logging
+import os
+import select
+import struct
+import time
+from pathlib import Path
+from typing import Iterator
+
+from apollo import index, scan
+
+# from <sys/inotify.h>
+IN_CLOSE_WRITE = 0x8
+IN_MOVED_TO = 0x80
+IN_CREATE = 0x100
+IN_Q_OVERFLOW = 0x4000
+IN_IGNORED = 0x8000
+IN_ONLYDIR = 0x1000000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = os.O_CLOEXEC
+
+_event = struct.Struct("iIII")
+
+
+class Inotify:
+    # the few inotify(7) calls needed, through libc so there is nothing to install
+    def __init__(self) -> None:
+        self._libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        self.fd = self._libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self._directories: dict[int, str] = {}
+
+    def add(self, directory: str, mask: int) -> None:
+        wd = self._libc.inotify_add_watch(self.fd, os.fsencode(directory), mask | IN_ONLYDIR)
+        if wd < 0:
+            raise OSError(ctypes.get_errno(), f"Unable to watch {directory}")
+        self._directories[wd] = directory
+
+    def read(self, timeout: float | None) -> list[tuple[str, int]]:
+        # (path, mask) of the events received within timeout, an empty path when events were lost
+        if not select.select([self.fd], [], [], timeout)[0]:
+            return []
+        try:
+            data = os.read(self.fd, 64 * 1024)
+        except BlockingIOError:
+            return []
+        events = []
+        offset = 0
+        while offset < len(data):
+            wd, mask, _, length = _event.unpack_from(data, offset)
+            name = data[offset + _event.size : offset + _event.size + length].rstrip(b"\0")
+            offset += _event.size + length
+            if mask & IN_Q_OVERFLOW:
+                events.append(("", mask))
+            elif mask & IN_IGNORED:
+                # folder deleted or moved away
+                self._directories.pop(wd, None)
+            elif wd in self._directories:
+                events.append((os.path.join(self._directories[wd], os.fsdecode(name)), mask))
+        return events
+
+    def close(self) -> None:
+        os.close(self.fd)
+
+
+class Watcher:
+    # media files appearing under root, handed out once their size and mtime stopped changing for settle seconds
+    def __init__(
+        self,
+        root: Path,
+        logger: logging.Logger,
+        extensions: frozenset[str],
+        excludes: tuple[str, ...] = (),
+        settle: float = 5.0,
+        poll_interval: float = 10.0,
+        use_inotify: bool = True,
+        file_index: index.FileIndex | None = None,
+    ) -> None:
+        self._root = os.fspath(root)
+        self._logger = logger
+        self._extensions = extensions
+        self._excluded = scan.exclude_pattern(excludes)
+        self._settle = settle
+        self._poll_interval = poll_interval
+        self._file_index = file_index
+        # path -> ((size, mtime_ns), since when)
+        self._pending: dict[str, tuple[tuple[int, int], float]] = {}
+        # every file seen by the last scan, polling only
+        self._known: dict[str, tuple[int, int]] = {}
+        self._inotify = None
+        if use_inotify:
+            try:
+                self._inotify = Inotify()
+            except (OSError, AttributeError) as exc:
+                logger.warning("Unable to use inotify, polling %s every %ss instead: %s", root, poll_interval, exc)
+        # watched before this first scan so nothing arriving during it is missed, files already there
+        # are pending too as they may still be written
+        self._scan(self._root)
+        self._last_scan = time.monotonic()
+
+    def _scan(self, directory: str) -> None:
+        known = {}
+        directories = [directory]
+        while directories:
+            directory = directories.pop()
+            if self._inotify is not None:
+                try:
+                    self._inotify.add(directory, IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE)
+                except OSError as exc:
+                    if exc.errno == errno.ENOSPC:
+                        self._logger.warning("Too many folders to watch, raise fs.inotify.max_user_watches")
+                    self._logger.warning("Unable to watch %s: %s", directory, exc)
+            files, subdirs = scan.list_directory(directory, self._root, self._extensions, self._excluded, self._logger)
+            directories.extend(subdirs)
+            for entry in files:
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                known[entry.path] = stat.st_size, stat.st_mtime_ns
+        for path, signature in known.items():
+            if self._known.get(path) != signature:
+                self._changed(path)
+        if self._inotify is None:
+            self._known = known
+
+    def _changed(self, path: str) -> None:
+        if path not in self._pending:
+            self._logger.debug("Waiting for %s to be complete", path)
+            self._pending[path] = (-1, -1), time.monotonic()
+
+    def _handle(self, path: str, mask: int) -> None:
+        if not path:
+            self._logger.warning("Missed file events, rescanning %s", self._root)
+            self._scan(self._root)
+        elif scan.is_excluded(self._excluded, path, self._root):
+            return
+        elif mask & IN_ISDIR:
+            # folders moved in come with their content, created ones may already have some
+            self._scan(path)
+        elif scan.is_media(path, self._extensions):
+            self._changed(path)
+
+    def _settled(self) -> list[Path]:
+        now = time.monotonic()
+        ready = []
+        for path, (signature, since) in list(self._pending.items()):
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                del self._pending[path]
+                continue
+            if (stat.st_size, stat.st_mtime_ns) != signature:
+                self._pending[path] = (stat.st_size, stat.st_mtime_ns), now
+            elif now - since >= self._settle:
+                del self._pending[path]
+                if self._file_index is not None and self._file_index.is_done(path, stat):
+                    continue
+                ready.append(Path(path))
+        return ready
+
+    def batches(self) -> Iterator[list[Path]]:
+        self._logger.info("Watching %s for new files", self._root)
+        try:
+            while True:
+                # pending files are checked every second, otherwise sleep until something happens
+                timeout = min(1.0, self._settle) if self._pending else None
+                if self._inotify is not None:
+                    for path, mask in self._inotify.read(timeout):
+                        self._handle(path, mask)
+                else:
+                    next_scan = self._last_scan + self._poll_interval - time.monotonic()
+                    time.sleep(max(0.0, min(next_scan, timeout if timeout is not None else next_scan)))
+                    if time.monotonic() >= self._last_scan + self._poll_interval:
+                        self._scan(self._root)
+                        self._last_scan = time.monotonic()
+                ready = self._settled()
+                if ready:
+                    yield sorted(ready)
+        except KeyboardInterrupt:
+            self._logger.info("Stopped watching %s", self._root)
+        finally:
+            if self._inotify is not None:
+                self._inotify.close()
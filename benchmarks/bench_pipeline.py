@@ -0,0 +1,229 @@
+import argparse
+import json
+import logging
+import random
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+# run from a checkout, without apollo installed
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from apollo import main, metrics
+
+from tmdb_stub import StubServer
+
+SCALES = {"1k": 1_000, "10k": 10_000, "100k": 100_000}
+
+WORDS = (
+    "Dark Night Last Red River Empire Secret Lost City Blue Winter Iron Golden Silent House Road Storm Shadow Ghost "
+    "King Queen Wild Black Star Fire Ocean Broken Hidden Glass Stone Paper Moon Sun Falling Rising Little Big "
+    "Code Zero Edge Line Heart Hunter Garden Machine Island Signal Echo Harbor Frontier Legacy Hollow Crown Summer"
+).split()
+QUALITIES = ("720p", "1080p", "2160p")
+SOURCES = ("WEB-DL", "BluRay", "HDTV", "WEBRip", "REMUX")
+CODECS = ("x264", "x265", "H.264", "HEVC")
+GROUPS = ("GRP", "NTb", "FLUX", "SPARKS", "TEPES", "KOGi")
+EXTENSIONS = (".mkv", ".mkv", ".mkv", ".mp4", ".avi")
+# what usually comes along with releases, never processed
+NOISE = (".nfo", ".jpg", ".srt", ".txt", ".sfv")
+
+
+def _title(rng: random.Random) -> str:
+    return " ".join(rng.sample(WORDS, rng.randint(1, 4)))
+
+
+def _tags(rng: random.Random) -> str:
+    return f"{rng.choice(QUALITIES)}.{rng.choice(SOURCES)}.{rng.choice(CODECS)}-{rng.choice(GROUPS)}"
+
+
+def _write(path: Path, size: int, stamp: int) -> None:
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with open(path, "wb") as media_file:
+        if size:
+            # sparse, with a distinct start so fingerprints differ
+            media_file.write(stamp.to_bytes(8, "little"))
+            media_file.truncate(size)
+
+
+def make_release_tree(root: Path, files: int, seed: int = 0, size: int = 0) -> int:
+    # movies, multi season shows and noise files named like downloads, returns the number of media files
+    rng = random.Random(seed)
+    written = media = 0
+
+    def _add(path: Path, is_media: bool = True) -> None:
+        nonlocal written, media
+        _write(path, size if is_media else 0, written)
+        written += 1
+        media += is_media
+
+    while written < files:
+        if rng.random() < 0.5:
+            name = f"{_title(rng).replace(' ', '.')}.{rng.randint(1950, 2025)}.{_tags(rng)}"
+            folder = root / "movies" / name
+            _add(folder / f"{name}{rng.choice(EXTENSIONS)}")
+            if rng.random() < 0.5:
+                _add(folder / f"sample-{name}.mkv", is_media=False)
+            for extension in rng.sample(NOISE, rng.randint(0, 2)):
+                _add(folder / f"{name}{extension}", is_media=False)
+            continue
+
+        show = _title(rng).replace(" ", ".")
+        tags = _tags(rng)
+        for season in range(1, rng.randint(1, 4) + 1):
+            folder = root / "shows" / f"{show}.S{season:02}.{tags}"
+            for number in range(1, rng.randint(6, 12) + 1):
+                name = f"{show}.S{season:02}E{number:02}.{tags}"
+                _add(folder / f"{name}.mkv")
+                if rng.random() < 0.3:
+                    _add(folder / f"{name}.srt", is_media=False)
+            _add(folder / f"{show}.S{season:02}.nfo", is_media=False)
+    return media
+
+
+def write_settings(directory: Path, url: str, args: argparse.Namespace) -> Path:
+    settings = directory / "settings.toml"
+    settings.write_text(
+        f"""[tmdb]
+account_id = "bench"
+token = "bench"
+url = "{url}"
+rate_limit = {args.rate_limit}
+pool_size = {max(20, args.jobs)}
+
+[cache]
+enabled = false
+
+[scan]
+exclude = ["sample*"]
+
+[index]
+path = "{directory / 'files.sqlite'}"
+fingerprint = {'true' if args.size else 'false'}
+
+[parse]
+processes = {args.processes}
+
+[batch]
+review_queue = "{directory / 'review.jsonl'}"
+
+[offline]
+enabled = false
+"""
+    )
+    return settings
+
+
+def bench(args: argparse.Namespace, files: int, stub: StubServer) -> dict:
+    with tempfile.TemporaryDirectory(prefix="apollo-bench-") as tmp:
+        directory = Path(tmp)
+        start = time.perf_counter()
+        media = make_release_tree(directory / "input", files, args.seed, args.size)
+        generated = time.perf_counter() - start
+        settings = write_settings(directory, stub.url, args)
+
+        sys.argv = ["apollo", args.command, str(directory / "input"), str(directory / "output")]
+        if args.command == "plan":
+            sys.argv.append(str(directory / "plan.jsonl"))
+        sys.argv += ["--batch", "--min-confidence", str(args.min_confidence), "--jobs", str(args.jobs)]
+        sys.argv += ["--settings", str(settings)]
+
+        metrics.default_metrics.reset()
+        stub.requests.clear()
+        start = time.perf_counter()
+        main.run()
+        seconds = time.perf_counter() - start
+
+    snapshot = metrics.default_metrics.to_dict()
+    return {
+        "files": files,
+        "media": media,
+        "generated": generated,
+        "seconds": seconds,
+        "throughput": media / seconds,
+        "stages": snapshot["timers"],
+        "counters": snapshot["counters"],
+        "requests": dict(stub.requests),
+    }
+
+
+def _change(current: float, baseline: float | None) -> str:
+    if not baseline:
+        return ""
+    return f"{(current - baseline) / baseline * 100:+.1f}%"
+
+
+def report(scale: str, result: dict, baseline: dict | None, threshold: float) -> list[str]:
+    # prints the result next to the baseline, returns what got slower by more than threshold
+    regressions = []
+    baseline = baseline or {}
+    change = _change(result["throughput"], baseline.get("throughput"))
+    print(
+        f"\n{scale}: {result['media']} media files of {result['files']} in {result['seconds']:.2f}s, "
+        f"{result['throughput']:.1f} files/s {change}"
+    )
+    if baseline and result["throughput"] < baseline["throughput"] * (1 - threshold):
+        regressions.append(f"{scale} throughput {change}")
+    print(f"TMDB stub: {', '.join(f'{count} {name}' for name, count in sorted(result['requests'].items()))}")
+    print(f"Counters: {', '.join(f'{value:g} {name}' for name, value in sorted(result['counters'].items()))}")
+
+    print(f"{'stage':<26}{'count':>8}{'mean':>11}{'p95':>11}{'total':>10}{'baseline':>11}{'change':>9}")
+    for name, stage in sorted(result["stages"].items()):
+        mean = stage["sum"] / stage["count"]
+        before = baseline.get("stages", {}).get(name)
+        before_mean = before["sum"] / before["count"] if before else None
+        print(
+            f"{name:<26}{stage['count']:>8}{mean * 1000:>9.2f}ms{stage['p95'] * 1000:>9.2f}ms{stage['sum']:>9.2f}s"
+            + (f"{before_mean * 1000:>9.2f}ms{_change(mean, before_mean):>9}" if before_mean else "")
+        )
+        # fast stages are too noisy to compare
+        if before_mean and before_mean > 0.0005 and mean > before_mean * (1 + threshold):
+            regressions.append(f"{scale} {name} {_change(mean, before_mean)}")
+    return regressions
+
+
+def run():
+    parser = argparse.ArgumentParser(description="time apollo end to end on synthetic release trees")
+    parser.add_argument("--scale", nargs="+", default=["1k"], help=f"{', '.join(SCALES)} or a number of files")
+    parser.add_argument("--command", choices=("run", "plan"), default="run", help="run moves files, plan does not")
+    parser.add_argument("--repeat", type=int, default=1, help="runs per scale, the fastest is kept")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--size", type=int, default=0, help="bytes per media file, > 0 also fingerprints them")
+    parser.add_argument("--jobs", "-j", type=int, default=8)
+    parser.add_argument("--processes", type=int, default=0, help="guessit worker processes")
+    parser.add_argument("--min-confidence", type=float, default=0.0)
+    parser.add_argument("--rate-limit", type=float, default=1000, help="TMDB requests per second")
+    parser.add_argument("--latency", type=float, default=0.02, help="seconds the TMDB stub takes per response")
+    parser.add_argument("--throttle", type=float, default=0.0, help="share of TMDB requests answered 429")
+    parser.add_argument("--retry-after", type=float, default=0.0, help="Retry-After of 429 responses")
+    parser.add_argument("--output", type=Path, help="save the results, to be used as a baseline")
+    parser.add_argument("--baseline", type=Path, help="results to compare with")
+    parser.add_argument("--threshold", type=float, default=0.1, help="slowdown reported as a regression")
+    args = parser.parse_args()
+
+    logging.getLogger("apollo").setLevel(logging.ERROR)
+    baseline = json.loads(args.baseline.read_text()) if args.baseline else {}
+    stub = StubServer(latency=args.latency, throttle=args.throttle, retry_after=args.retry_after, seed=args.seed)
+    stub.start()
+
+    results = {}
+    regressions = []
+    try:
+        for scale in args.scale:
+            files = SCALES.get(scale) or int(scale)
+            runs = [bench(args, files, stub) for _ in range(args.repeat)]
+            results[scale] = max(runs, key=lambda result: result["throughput"])
+            regressions += report(scale, results[scale], baseline.get(scale), args.threshold)
+    finally:
+        stub.shutdown()
+
+    if args.output:
+        args.output.write_text(json.dumps(results, indent=2))
+    if regressions:
+        print(f"\nSlower than {args.baseline} by more than {args.threshold:.0%}: {', '.join(regressions)}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    run()
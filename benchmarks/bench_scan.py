@@ -0,0 +1,78 @@
+import argparse
+import logging
+import random
+import tempfile
+import time
+from pathlib import Path
+
+from apollo import common
+
+logger = logging.getLogger(__name__)
+
+
+def rglob_inputs(input: Path, logger: logging.Logger):
+    # implementation replaced by the scandir walker, kept for comparison
+    for file in input.rglob("*"):
+        if not file.is_file():
+            continue
+        if file.suffix not in [".mp4", ".mkv", ".avi"]:
+            logger.debug("Ignoring %s", file.absolute().as_posix())
+            continue
+        yield file
+
+
+def make_tree(root: Path, shows: int, seasons: int, episodes: int, movies: int, seed: int = 0):
+    rng = random.Random(seed)
+    for show in range(shows):
+        for season in range(1, seasons + 1):
+            folder = root / f"Show.{show}.S{season:02}.1080p.WEB" / f"Season {season}"
+            folder.mkdir(parents=True)
+            for episode in range(1, episodes + 1):
+                (folder / f"Show.{show}.S{season:02}E{episode:02}.1080p.WEB.x264.mkv").touch()
+                (folder / f"Show.{show}.S{season:02}E{episode:02}.1080p.WEB.x264.nfo").touch()
+    for movie in range(movies):
+        folder = root / f"Movie.{movie}.{rng.randint(1950, 2024)}.2160p.BluRay"
+        folder.mkdir()
+        (folder / f"{folder.name}.{rng.choice(['mkv', 'mp4', 'avi'])}").touch()
+        (folder / "sample.mkv").touch()
+        (folder / "poster.jpg").touch()
+
+
+def measure(name: str, func, repeat: int):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        count = sum(1 for _ in func())
+        timings.append(time.perf_counter() - start)
+    best = min(timings)
+    print(f"{name:<24} {count:>8} files {best * 1000:>10.1f} ms {count / best:>12.0f} files/s")
+
+
+def run():
+    parser = argparse.ArgumentParser(description="compare input scanners on a synthetic tree")
+    parser.add_argument("--shows", type=int, default=50)
+    parser.add_argument("--seasons", type=int, default=5)
+    parser.add_argument("--episodes", type=int, default=20)
+    parser.add_argument("--movies", type=int, default=2000)
+    parser.add_argument("--workers", type=int, default=8)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--root", type=Path, help="scan an existing tree instead of a synthetic one")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        root = args.root
+        if root is None:
+            root = Path(tmp)
+            make_tree(root, args.shows, args.seasons, args.episodes, args.movies)
+
+        measure("rglob", lambda: rglob_inputs(root, logger), args.repeat)
+        measure("scandir", lambda: common.iterate_inputs(root, logger), args.repeat)
+        measure(
+            f"scandir ({args.workers} workers)",
+            lambda: common.iterate_inputs(root, logger, workers=args.workers),
+            args.repeat,
+        )
+
+
+if __name__ == "__main__":
+    run()
@@ -0,0 +1,151 @@
+import argparse
+import collections
+import http.server
+import json
+import random
+import re
+import threading
+import time
+import zlib
+from urllib.parse import parse_qs, urlparse
+
+# the TMDB endpoints apollo calls, answering every search with the title and year searched for
+
+
+class StubServer(http.server.ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(
+        self,
+        port: int = 0,
+        latency: float = 0.0,
+        throttle: float = 0.0,
+        retry_after: float = 0.0,
+        seed: int = 0,
+    ) -> None:
+        super().__init__(("127.0.0.1", port), StubHandler)
+        self.latency = latency
+        # share of requests answered 429 Too Many Requests
+        self.throttle = throttle
+        self.retry_after = retry_after
+        self.requests = collections.Counter()
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        # id -> details, filled by searches so details match what was found
+        self._media: dict[int, dict] = {}
+
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self.server_port}/3/"
+
+    def start(self) -> "StubServer":
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+    def throttled(self) -> bool:
+        with self._lock:
+            return self.throttle > 0 and self._random.random() < self.throttle
+
+    def count(self, name: str) -> None:
+        with self._lock:
+            self.requests[name] += 1
+
+    def search(self, media_type: str, query: str, year: str | None) -> dict:
+        tmdb_id = zlib.crc32(f"{media_type}:{query.lower()}".encode()) % 1_000_000
+        date = f"{year or 2000}-01-01"
+        if media_type == "movie":
+            media = {"id": tmdb_id, "title": query, "original_title": query, "release_date": date}
+        else:
+            media = {"id": tmdb_id, "name": query, "original_name": query, "first_air_date": date}
+        media.update(overview="", popularity=10.0, original_language="en")
+        with self._lock:
+            self._media.setdefault(tmdb_id, media)
+        return media
+
+    def details(self, tmdb_id: int) -> dict | None:
+        with self._lock:
+            return self._media.get(tmdb_id)
+
+
+def episode(season: int, number: int) -> dict:
+    return {
+        "id": season * 1000 + number,
+        "name": f"Episode {number}",
+        "season_number": season,
+        "episode_number": number,
+        "overview": "",
+        "air_date": "2000-01-01",
+    }
+
+
+class StubHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    server: StubServer
+
+    def do_GET(self) -> None:
+        if self.server.latency:
+            time.sleep(self.server.latency)
+        url = urlparse(self.path)
+        path = url.path.removeprefix("/3")
+        query = {name: values[0] for name, values in parse_qs(url.query).items()}
+
+        if self.server.throttled():
+            self.server.count("throttled")
+            return self._reply(429, {"status_code": 25}, {"Retry-After": f"{self.server.retry_after:g}"})
+
+        data = None
+        if match := re.fullmatch(r"/search/(movie|tv)", path):
+            self.server.count("search")
+            year = query.get("year") or query.get("first_air_date_year")
+            data = {"results": [self.server.search(match[1], query.get("query", ""), year)]}
+        elif match := re.fullmatch(r"/(movie|tv)/(\d+)/alternative_titles", path):
+            self.server.count("alternative_titles")
+            data = {"id": int(match[2]), "titles": [], "results": []}
+        elif match := re.fullmatch(r"/tv/(\d+)/season/(\d+)/episode/(\d+)", path):
+            self.server.count("episode")
+            data = episode(int(match[2]), int(match[3]))
+        elif match := re.fullmatch(r"/tv/(\d+)/season/(\d+)", path):
+            self.server.count("season")
+            season = int(match[2])
+            data = {"id": season, "season_number": season, "episodes": [episode(season, n) for n in range(1, 31)]}
+        elif match := re.fullmatch(r"/(movie|tv)/(\d+)", path):
+            self.server.count("details")
+            data = self.server.details(int(match[2]))
+
+        if data is None:
+            self.server.count("not found")
+            return self._reply(404, {"status_code": 34})
+        self._reply(200, data)
+
+    def _reply(self, status: int, data: dict, headers: dict[str, str] | None = None) -> None:
+        body = json.dumps(data).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format: str, *args) -> None:
+        pass
+
+
+def run():
+    parser = argparse.ArgumentParser(description="serve a fake TMDB API, point [tmdb] url at it")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--latency", type=float, default=0.05, help="seconds added to every response")
+    parser.add_argument("--throttle", type=float, default=0.0, help="share of requests answered 429")
+    parser.add_argument("--retry-after", type=float, default=1.0, help="Retry-After of 429 responses, in seconds")
+    args = parser.parse_args()
+
+    server = StubServer(args.port, args.latency, args.throttle, args.retry_after)
+    print(f"Serving {server.url}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print(dict(server.requests))
+
+
+if __name__ == "__main__":
+    run()